@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
+import base64
 import contextlib
+import functools
 import hashlib
 import json
 import mimetypes
+import mmap
 import os
 import pathlib
+import re
 import signal
 import sys
 import threading
@@ -20,7 +25,11 @@ import boto3
 import botocore
 import colorama
 import pathspec
-from boto3.resources.base import ServiceResource as AWSServiceResource
+from boto3.s3.transfer import TransferConfig
+from boto3.s3.transfer import TransferManager
+from boto3.s3.transfer import create_transfer_manager
+from botocore.client import BaseClient as AWSClient
+from botocore.config import Config as AWSConfig
 from colorama import init as colorama_init
 from tqdm import tqdm
 
@@ -35,6 +44,20 @@ VALID_ACLS = [
 
 QUIET = False
 
+RESET_COLOR = colorama.Style.RESET_ALL
+
+# files at or above this size are sent as concurrent multipart uploads
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+# the most keys S3 will remove in a single DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+# how much older than its S3 copy a large file has to be before it's trusted as
+# unchanged without hashing it; covers LastModified's whole seconds and a little
+# clock drift
+MTIME_TOLERANCE = 2
+# the start of a named group in a pattern's regex, so it can be made
+# non-capturing when the patterns are fused
+NAMED_GROUP = re.compile(r"(?<!\\)\(\?P<\w+>")
+
 # From https://mzl.la/39XkRvH
 MIMETYPES = {
     "application/manifest+json": [".webmanifest"],
@@ -67,39 +90,92 @@ for mimetype in MIMETYPES:
         mimetypes.add_type(mimetype, extension)
 
 
+# lets each environment deployed at the same time keep its progress bars on
+# its own line
+bar_position = threading.local()
+
+
 def get_progress_bar(*args, **kwargs) -> tqdm:
     kwargs.setdefault("unit", "files")
     kwargs.setdefault("colour", "GREEN")
+    kwargs.setdefault("position", getattr(bar_position, "value", None))
     if QUIET:
         kwargs["disable"] = True
     return tqdm(*args, **kwargs)
 
 
-# inspired by
-# https://www.peterbe.com/plog/fastest-way-to-find-out-if-a-file-exists-in-s3
-def key_exists(
-    s3: AWSServiceResource,
+def get_object_head(
+    s3_client: AWSClient,
     bucket_name: str,
     key_name: str,
-) -> bool:
-    bucket = s3.Bucket(bucket_name)
-    for obj in bucket.objects.filter(Prefix=key_name):
-        if obj.key == key_name:
-            return True
-    return False
-
-
-OUTPUT = []
+) -> typing.Optional[typing.Dict]:
+    try:
+        return s3_client.head_object(Bucket=bucket_name, Key=key_name)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] == "404":
+            return None
+        raise e  # pragma: no cover
 
 
-def display_output():
-    while len(OUTPUT):
-        text, is_error = OUTPUT.pop()
-        if QUIET and not is_error:
-            continue  # pragma: no cover
-        buffer = sys.stderr if is_error else sys.stdout
-        buffer.write(f"{text}\n")
-        buffer.flush()
+def list_remote_objects(
+    s3_client: AWSClient,
+    bucket_name: str,
+    prefix: str,
+) -> typing.Dict[str, typing.Dict]:
+    remote_index = {}
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            remote_index[obj["Key"]] = obj
+    return remote_index
+
+
+def get_remote_index(
+    s3_client: AWSClient,
+    bucket_name: str,
+    bucket_path: str,
+    processes: int = 1,
+) -> typing.Dict[str, typing.Dict]:
+    # keys are always bucket_path + "/" + the file's path, so listing with the
+    # slash keeps out "sibling" paths like "site-old" when syncing to "site" (and
+    # keeps --delete from removing them)
+    prefix = bucket_path.strip("/")
+    if prefix:
+        prefix += "/"
+    if processes < 2:
+        return list_remote_objects(s3_client, bucket_name, prefix)
+    return split_remote_listing(s3_client, bucket_name, prefix, processes)
+
+
+def split_remote_listing(
+    s3_client: AWSClient,
+    bucket_name: str,
+    prefix: str,
+    processes: int,
+) -> typing.Dict[str, typing.Dict]:
+    # a listing only returns 1000 keys per request, so big prefixes are split
+    # on their subdirectories and those are listed at the same time; prefix is
+    # used exactly as given since keys like "site//a.html" are valid
+    remote_index = {}
+    sub_prefixes = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter="/"):
+        for obj in page.get("Contents", []):
+            remote_index[obj["Key"]] = obj
+        sub_prefixes += [x["Prefix"] for x in page.get("CommonPrefixes", [])]
+    if len(sub_prefixes) == 1 and sub_prefixes[0] != prefix:
+        # nothing to split at this level, so look one level further down
+        remote_index.update(
+            split_remote_listing(s3_client, bucket_name, sub_prefixes[0], processes)
+        )
+    elif sub_prefixes:
+        with futures.ThreadPoolExecutor(max_workers=processes) as executor:
+            for sub_index in executor.map(
+                functools.partial(list_remote_objects, s3_client, bucket_name),
+                sub_prefixes,
+            ):
+                remote_index.update(sub_index)
+    return remote_index
 
 
 def alert(
@@ -107,21 +183,16 @@ def alert(
     error_code: typing.Optional[int] = None,
     color: typing.Optional[str] = None,
 ):
-    if color is None:
-        color = (
-            colorama.Fore.RED
-            if error_code and not error_code == os.EX_OK
-            else colorama.Style.RESET_ALL
-        )
+    is_error = error_code not in (None, os.EX_OK)
     if not QUIET:
-        OUTPUT.append(
-            (
-                f"{color}{text}{colorama.Style.RESET_ALL}",
-                error_code not in [None, os.EX_OK],
-            )
+        if color is None:
+            color = colorama.Fore.RED if is_error else RESET_COLOR
+        # tqdm.write is thread safe and keeps any progress bars below the text
+        tqdm.write(
+            f"{color}{text}{RESET_COLOR}",
+            file=sys.stderr if is_error else sys.stdout,
         )
     if error_code is not None:
-        display_output()
         sys.exit(error_code)
 
 
@@ -174,7 +245,10 @@ def check_for_updates(
             print("checking for update")
         # it has been a day since the last update check
         try:
-            with contextlib.closing(urllib.request.urlopen(PYPI_URL)) as pypi_response:
+            # a short timeout so a hung connection can't hold up the deploy
+            with contextlib.closing(
+                urllib.request.urlopen(PYPI_URL, timeout=2)
+            ) as pypi_response:
                 pypi_data = json.load(pypi_response)
                 pypi_version = parse_version(pypi_data.get("info", {}).get("version"))
                 if pypi_version > parse_version(this_version):
@@ -200,11 +274,83 @@ def check_for_updates(
     return update_available
 
 
+# a config only depends on the worker count, so each one is built once and
+# shared by every upload that uses it
+@functools.lru_cache(maxsize=None)
+def get_transfer_config(processes: int = 10) -> TransferConfig:
+    return TransferConfig(
+        multipart_threshold=MULTIPART_THRESHOLD,
+        multipart_chunksize=MULTIPART_THRESHOLD,
+        max_concurrency=processes,
+        use_threads=True,
+    )
+
+
+def get_cache_controls(caches: typing.Dict[str, int]) -> typing.Dict[str, str]:
+    return build_cache_controls(frozenset(caches.items()))
+
+
+# every sync and every file that isn't in the content headers table asks for
+# the same few settings, so each set is only turned into headers once; the
+# results are shared, so callers copy them instead of changing them
+@functools.lru_cache(maxsize=None)
+def build_cache_controls(
+    caches: typing.FrozenSet[typing.Tuple[str, int]],
+) -> typing.Dict[str, str]:
+    cache_controls = {}
+    for mimetype, cache_timeout in caches:
+        if cache_timeout == 0:
+            cache_controls[mimetype] = f"max-age={cache_timeout}, private"
+        else:
+            cache_controls[mimetype] = f"max-age={cache_timeout}, public"
+    return cache_controls
+
+
+def get_mimetype_headers(
+    mimetype: typing.Optional[str],
+    charset: typing.Optional[str],
+    cache_controls: typing.Dict[str, str],
+) -> typing.Dict[str, str]:
+    headers = {}
+    if mimetype:
+        mimetype_family = mimetype.partition("/")[0]
+        if charset and mimetype_family == "text":
+            headers["ContentType"] = f"{mimetype};charset={charset}"
+        else:
+            headers["ContentType"] = mimetype
+        if mimetype in cache_controls:
+            headers["CacheControl"] = cache_controls[mimetype]
+        elif f"{mimetype_family}/*" in cache_controls:
+            headers["CacheControl"] = cache_controls[f"{mimetype_family}/*"]
+    return headers
+
+
+# sync_files builds this once so upload_file can look up its headers by
+# extension instead of guessing the mimetype of every file
+def get_content_headers(
+    caches: typing.Dict[str, int],
+    charset: typing.Optional[str] = None,
+) -> typing.Dict[str, typing.Dict[str, str]]:
+    return build_content_headers(frozenset(caches.items()), charset)
+
+
+@functools.lru_cache(maxsize=None)
+def build_content_headers(
+    caches: typing.FrozenSet[typing.Tuple[str, int]],
+    charset: typing.Optional[str] = None,
+) -> typing.Dict[str, typing.Dict[str, str]]:
+    cache_controls = build_cache_controls(caches)
+    return {
+        extension: get_mimetype_headers(mimetype, charset, cache_controls)
+        for extension, mimetype in mimetypes.types_map.items()
+    }
+
+
 # this is where the actual upload happens, called by sync_files
 def upload_file(
     file_name: pathlib.Path,
     bucket_name: str,
-    s3: AWSServiceResource,
+    s3_client: AWSClient,
     bucket_path: str,
     prefix: pathlib.Path,
     acl: typing.Optional[str] = None,
@@ -213,31 +359,78 @@ def upload_file(
     charset: typing.Optional[str] = None,
     caches: typing.Optional[typing.Dict[str, int]] = None,
     bar: typing.Optional[tqdm] = None,
+    transfer_manager: typing.Optional[TransferManager] = None,
+    content_headers: typing.Optional[typing.Dict[str, typing.Dict[str, str]]] = None,
+    remote_index: typing.Optional[typing.Dict[str, typing.Dict]] = None,
 ) -> typing.Tuple[str, bool]:
-    if killswitch.is_set():
-        return (file_name, 0)
-    if caches is None:
-        caches = {}
     updated = 0
 
     if not isinstance(file_name, pathlib.Path):
         file_name = pathlib.Path(file_name)
 
+    # files found by walking the prefix start with it, so slicing the string is
+    # enough and skips building intermediate paths in relative_to
+    file_path, prefix_path = str(file_name), str(prefix)
+    if file_path.startswith(prefix_path + os.sep):
+        relative_name = file_path[len(prefix_path) + 1 :]
+    else:
+        relative_name = str(file_name.relative_to(prefix))
     key_name = "/".join(
-        [bucket_path.rstrip("/"), str(file_name.relative_to(prefix)).lstrip("/")]
+        [bucket_path.rstrip("/"), relative_name.replace(os.sep, "/").lstrip("/")]
     ).lstrip("/")
-    if key_exists(s3, bucket_name, key_name):
-        s3_obj = s3.Object(bucket_name, key_name)
+    if remote_index is None:
+        s3_obj = get_object_head(s3_client, bucket_name, key_name)
     else:
-        s3_obj = None
-    local_md5 = hashlib.md5()
+        s3_obj = remote_index.get(key_name)
+    local_stat = os.stat(file_name)
+    if (
+        s3_obj is not None
+        and not force
+        # multipart ETags aren't an MD5, so checking them means hashing the
+        # whole (large) file and fetching the stored hash; a file that's the
+        # same size and hasn't been touched since it was uploaded is left alone
+        and "-" in s3_obj["ETag"]
+        and s3_obj.get("Size", s3_obj.get("ContentLength")) == local_stat.st_size
+        and local_stat.st_mtime < s3_obj["LastModified"].timestamp() - MTIME_TOLERANCE
+    ):
+        alert(f"Skipped {file_name}: already up-to-date")
+        if bar:
+            bar.update()
+        return (key_name.lstrip("/"), updated)
+    # hash and upload through one handle instead of opening the file twice
     with open(file_name, "rb") as local_file:
-        for chunk in iter(lambda: local_file.read(4096), b""):
-            local_md5.update(chunk)
-    local_md5 = local_md5.hexdigest()
-    mimetype = mimetypes.guess_type(file_name)
-    if s3_obj is None or force or not s3_obj.metadata.get("d3ploy-hash") == local_md5:
-        with open(file_name, "rb") as local_file:
+        local_size = local_stat.st_size
+        # hashing releases the GIL, so the workers hash their files in parallel;
+        # the MD5 only detects changes, so FIPS builds that block it for
+        # security use can still run it
+        if local_size >= MULTIPART_THRESHOLD:
+            # large files are hashed straight from the page cache in one call
+            # instead of being copied through a read buffer a chunk at a time
+            with mmap.mmap(
+                local_file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as local_data:
+                local_digest = hashlib.md5(local_data, usedforsecurity=False)
+        else:
+            local_digest = hashlib.file_digest(
+                local_file,
+                lambda: hashlib.md5(usedforsecurity=False),
+            )
+        local_md5 = local_digest.hexdigest()
+        if s3_obj is None or force:
+            up_to_date = False
+        elif s3_obj.get("Size", s3_obj.get("ContentLength")) != local_size:
+            # a different size can't be the same content, whatever the ETag is
+            up_to_date = False
+        elif s3_obj["ETag"].strip('"') == local_md5:
+            # the ETag is the MD5 of single part uploads
+            up_to_date = True
+        else:
+            # multipart and KMS encrypted objects have other ETags, so fall back
+            # to the hash we stored in the metadata, which listings don't include
+            if "Metadata" not in s3_obj:
+                s3_obj = get_object_head(s3_client, bucket_name, key_name) or {}
+            up_to_date = s3_obj.get("Metadata", {}).get("d3ploy-hash") == local_md5
+        if not up_to_date:
             updated += 1
             if dry_run:
                 if bar:  # pragma: no cover
@@ -248,73 +441,187 @@ def upload_file(
             }
             if acl is not None:
                 extra_args["ACL"] = acl
-            if charset and mimetype[0] and mimetype[0].split("/")[0] == "text":
-                extra_args["ContentType"] = f"{mimetype[0]};charset={charset}"
-            elif mimetype[0]:
-                extra_args["ContentType"] = mimetype[0]
-            cache_timeout = None
-            if mimetype[0] in caches.keys():
-                cache_timeout = caches.get(mimetype[0])
-            elif mimetype[0] and f"{mimetype[0].split('/')[0]}/*" in caches.keys():
-                cache_timeout = caches.get(f"{mimetype[0].split('/')[0]}/*")
-            if cache_timeout is not None:
-                if cache_timeout == 0:
-                    extra_args["CacheControl"] = f"max-age={cache_timeout}, private"
-                else:
-                    extra_args["CacheControl"] = f"max-age={cache_timeout}, public"
-
-            s3.meta.client.upload_fileobj(
-                local_file,
-                bucket_name,
-                key_name,
-                ExtraArgs=extra_args,
-            )
-    else:
-        if s3_obj and s3_obj.metadata.get("d3ploy-hash") == local_md5:
+            headers = (content_headers or {}).get(file_name.suffix.lower())
+            if headers is None:
+                # compound extensions like .tar.gz aren't in the table
+                headers = get_mimetype_headers(
+                    mimetypes.guess_type(file_name)[0],
+                    charset,
+                    get_cache_controls(caches or {}),
+                )
+            extra_args.update(headers)
+
+            local_file.seek(0)
+            if local_size < MULTIPART_THRESHOLD:
+                # small files go up in a single request, so S3 can check the
+                # body against the hash we already have and its ETag will match
+                s3_client.put_object(
+                    Bucket=bucket_name,
+                    Key=key_name,
+                    Body=local_file,
+                    ContentMD5=base64.b64encode(local_digest.digest()).decode(),
+                    **extra_args,
+                )
+            elif transfer_manager is None:
+                # large files are handed over by name: s3transfer streams each
+                # part straight from disk that way, where a file object gets
+                # every part copied into memory first
+                s3_client.upload_file(
+                    str(file_name),
+                    bucket_name,
+                    key_name,
+                    ExtraArgs=extra_args,
+                    Config=get_transfer_config(),
+                )
+            else:
+                transfer_manager.upload(
+                    str(file_name),
+                    bucket_name,
+                    key_name,
+                    extra_args=extra_args,
+                ).result()
+        else:
             alert(f"Skipped {file_name}: already up-to-date")
     if bar:
         bar.update()
     return (key_name.lstrip("/"), updated)
 
 
+def run_jobs(
+    processes: int,
+    func: typing.Callable,
+    items: typing.Iterable,
+    *args,
+    **kwargs,
+) -> typing.List:
+    # only a few jobs per worker are queued at a time, so large deploys don't
+    # hold a future for every file in memory before any of them finish
+    slots = threading.BoundedSemaphore(processes * 8)
+    lock = threading.Lock()
+    results = []
+    errors = []
+
+    def collect(job: futures.Future):
+        with lock:
+            if job.cancelled():
+                pass  # jobs dropped after Ctrl-C have nothing to collect
+            elif job.exception() is not None:
+                errors.append(job.exception())
+            else:
+                results.append(job.result())
+        slots.release()
+
+    executor = futures.ThreadPoolExecutor(max_workers=processes)
+    try:
+        for item in items:
+            slots.acquire()
+            if killswitch.is_set():
+                break
+            executor.submit(func, item, *args, **kwargs).add_done_callback(collect)
+    finally:
+        # after Ctrl-C, jobs that haven't started are dropped instead of each
+        # being run just to return early
+        executor.shutdown(cancel_futures=killswitch.is_set())
+    if errors:
+        raise errors[0]
+    return results
+
+
 def get_confirmation(message: str) -> bool:  # pragma: no cover
     confirm = input(f"{message} [yN]: ")
 
     return confirm.lower() in ["y", "yes"]
 
 
-# this where the actual removal happens, called by sync_files
-def delete_file(
-    key_name: str,
+# removes up to DELETE_BATCH_SIZE keys in one request, called by sync_files
+def delete_files(
+    key_names: typing.Collection[str],
     bucket_name: str,
-    s3: AWSServiceResource,
-    needs_confirmation: bool = False,
+    s3_client: AWSClient,
     bar: typing.Optional[tqdm] = None,
     dry_run: bool = False,
 ) -> int:
-    if killswitch.is_set():
-        return 0
-    deleted = 0
-    if needs_confirmation:
-        confirmed = get_confirmation(
-            f"{chr(10) if bar else ''}Remove {bucket_name}/{key_name.lstrip('/')}"
-        )
-    else:
-        confirmed = True
-    if confirmed:
-        deleted += 1
-        if not dry_run:
-            s3.Object(bucket_name, key_name).delete()
-    else:
-        alert(
-            f"{chr(10) if bar and not needs_confirmation else ''}Skipping removal of "
-            f"{bucket_name}/{key_name.lstrip('/')}",
+    deleted = len(key_names)
+    if not dry_run:
+        response = s3_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={
+                "Objects": [{"Key": key_name} for key_name in key_names],
+                "Quiet": True,
+            },
         )
+        for error in response.get("Errors", []):  # pragma: no cover
+            deleted -= 1
+            alert(
+                f"Could not remove {bucket_name}/{error['Key']}: {error['Message']}",
+                color=colorama.Fore.RED,
+            )
     if bar:
-        bar.update()
+        bar.update(len(key_names))
     return deleted
 
 
+def walk_files(
+    path: typing.Union[pathlib.Path, str],
+    skip_directories: typing.Collection[str] = (),
+    is_pruned: typing.Optional[typing.Callable[[str], bool]] = None,
+    pruned: typing.Optional[typing.List[str]] = None,
+) -> typing.Iterator[os.DirEntry]:
+    # scandir entries cache their type from the directory listing, so this saves
+    # the extra stat calls os.walk makes for every name
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if entry.is_symlink() or entry.name in skip_directories:
+                    continue  # pragma: no cover
+                # directory patterns match the path with a trailing slash
+                if is_pruned is not None and is_pruned(entry.path + os.sep):
+                    if pruned is not None:
+                        pruned.append(entry.path)
+                    continue
+                yield from walk_files(entry.path, skip_directories, is_pruned, pruned)
+            else:
+                yield entry
+
+
+# pathspec tries every pattern in turn against each path, so the patterns are
+# fused into one regex and each path is checked with a single match instead
+def compile_ignore_patterns(
+    patterns: typing.Collection[pathspec.Pattern],
+) -> typing.Callable[[str], bool]:
+    patterns = [x for x in patterns if x.include is not None]
+    if not patterns:
+        return lambda path: False
+    # the last pattern that matches decides, but an alternation stops at the
+    # first alternative that matches, so the patterns are joined backwards; the
+    # patterns' own named groups would clash once joined, so they're made
+    # non-capturing, and anything that still won't fuse (a backreference, inline
+    # flags) is matched by pathspec itself
+    try:
+        fused = re.compile(
+            "|".join(
+                f"(?P<p{i}>{NAMED_GROUP.sub('(?:', x.regex.pattern)})"
+                for i, x in reversed(list(enumerate(patterns)))
+            )
+        )
+    except re.error:
+        return pathspec.PathSpec(patterns).match_file
+
+    def is_ignored(path: str) -> bool:
+        match = fused.match(pathspec.util.normalize_file(path))
+        return match is not None and patterns[int(match.lastgroup[1:])].include
+
+    return is_ignored
+
+
+def read_gitignore(
+    gitignore_file: typing.Union[pathlib.Path, str],
+) -> typing.List[pathspec.Pattern]:
+    with open(gitignore_file) as f:
+        spec = pathspec.PathSpec.from_lines("gitwildmatch", f)
+    return [x for x in spec.patterns if x.regex]
+
+
 def determine_files_to_sync(
     local_path: typing.Union[pathlib.Path, str],
     excludes: typing.Optional[typing.Union[typing.Collection, str]] = None,
@@ -324,50 +631,52 @@ def determine_files_to_sync(
         excludes = []
     if isinstance(excludes, str):
         excludes = [excludes]
-    excludes.append(".gitignore")
+    # copied so the caller's list doesn't grow with every sync
+    excludes = list(excludes) + [".gitignore"]
     if not isinstance(local_path, pathlib.Path):
         local_path = pathlib.Path(local_path)
     gitignore_patterns = list(map(pathspec.patterns.GitWildMatchPattern, excludes))
+    gitignores = []
+    if gitignore and pathlib.Path(".gitignore").exists():
+        gitignores.append(".gitignore")
+        gitignore_patterns += read_gitignore(".gitignore")
     svc_directories = [".git", ".svn"]
+    # directories the patterns known up front already ignore aren't walked at
+    # all; a negated pattern could bring back files inside one, so nothing is
+    # pruned when there are any
+    is_pruned = None
+    if all(x.include is not False for x in gitignore_patterns):
+        is_pruned = compile_ignore_patterns(gitignore_patterns)
+    local_files = []
+    if local_path.is_dir():
+        pruned = []
+        local_files = list(walk_files(local_path, svc_directories, is_pruned, pruned))
+        # the same goes for a negation in a .gitignore inside a pruned
+        # directory, which can't be known until it's read, so the walk is done
+        # again without pruning if there is one
+        if gitignore and any(
+            x.name == ".gitignore"
+            for directory in pruned
+            for x in walk_files(directory, svc_directories)
+        ):
+            local_files = list(walk_files(local_path, svc_directories))
     if gitignore:
-        gitignores = []
-        if pathlib.Path(".gitignore").exists():
-            gitignores.append(".gitignore")
-        for root, dir_names, file_names in os.walk(local_path):
-            for dir_name in dir_names:
-                if dir_name in svc_directories:
-                    continue  # pragma: no cover
-                dir_name = os.path.join(root, dir_name)
-                gitignore_path = os.path.join(dir_name, ".gitignore")
-                if os.path.exists(gitignore_path):
-                    gitignores.append(gitignore_path)
-            for file_name in file_names:
-                if file_name == ".gitignore":
-                    gitignore_path = os.path.join(root, file_name)
-                    gitignores.append(gitignore_path)
-        for gitignore_file in gitignores:
-            with open(gitignore_file) as f:
-                spec = pathspec.PathSpec.from_lines("gitwildmatch", f)
-                gitignore_patterns += [x for x in spec.patterns if x.regex]
+        for entry in local_files:
+            if entry.name == ".gitignore":
+                gitignores.append(entry.path)
+                gitignore_patterns += read_gitignore(entry.path)
         if not gitignores:
             alert(
                 "--gitignore option set, but no .gitignore files were found",
                 color=colorama.Fore.RED,
             )
-    gitignore_spec = pathspec.PathSpec(gitignore_patterns)
+    is_ignored = compile_ignore_patterns(gitignore_patterns)
 
     files = []
     if local_path.is_dir():
-        for root, dir_names, file_names in os.walk(local_path):
-            for file_name in file_names:
-                file_name = pathlib.Path(root) / file_name
-                if not gitignore_spec.match_file(file_name):
-                    files.append(file_name)
-            for svc_directory in svc_directories:
-                if svc_directory in dir_names:
-                    dir_names.remove(svc_directory)  # pragma: no cover
+        files = [pathlib.Path(x.path) for x in local_files if not is_ignored(x.path)]
     elif local_path.is_file() or local_path.is_symlink():
-        if not gitignore_spec.match_file(local_path):
+        if not is_ignored(str(local_path)):
             files.append(local_path)
     return files
 
@@ -378,8 +687,12 @@ def invalidate_cloudfront(
     dry_run: bool = False,
 ) -> typing.List[str]:
     output = []
-    if not isinstance(cloudfront_id, list):
+    if isinstance(cloudfront_id, str):
         cloudfront_id = [cloudfront_id]
+    # one invalidation covers the whole distribution, so an ID listed twice
+    # (e.g. by the defaults and the environment) is only sent once
+    cloudfront_id = list(dict.fromkeys(cloudfront_id))
+    cloudfront = None
     for cf_id in cloudfront_id:
         if dry_run:
             alert(
@@ -387,7 +700,8 @@ def invalidate_cloudfront(
                 color=colorama.Fore.GREEN,
             )
         else:
-            cloudfront = boto3.client("cloudfront")
+            if cloudfront is None:
+                cloudfront = boto3.client("cloudfront")
             # we don't specify the individual paths because that's more
             # costly monetarily speaking
             response = cloudfront.create_invalidation(
@@ -421,6 +735,7 @@ def sync_files(
     confirm: bool = False,
     cloudfront_id: typing.Optional[typing.Union[typing.Collection[str], str]] = None,
     caches: typing.Optional[typing.Dict[str, int]] = None,
+    s3_client: typing.Optional[AWSClient] = None,
 ) -> typing.Dict[str, int]:
     alert(f'Using settings for "{env}" environment')
 
@@ -439,85 +754,123 @@ def sync_files(
             os.EX_NOINPUT,
         )
 
-    s3 = boto3.resource("s3")
+    session = None
+    if s3_client is None:
+        # each sync gets its own session since sessions aren't safe to share
+        # between threads
+        session = boto3.session.Session()
+        # the upload workers and the transfer manager's threads share this
+        # client, so give it enough pooled connections that none get thrown
+        # away, keep them alive between requests and back off adaptively when
+        # throttled
+        s3_client = session.client(
+            "s3",
+            config=AWSConfig(
+                max_pool_connections=max(processes * 2, 20),
+                tcp_keepalive=True,
+                retries={"mode": "adaptive", "max_attempts": 5},
+            ),
+        )
 
     # test the bucket connection
     try:
-        s3.meta.client.head_bucket(Bucket=bucket_name)
-        bucket = s3.Bucket(bucket_name)
-    except botocore.exceptions.ClientError as e:  # pragma: no cover
+        s3_client.head_bucket(Bucket=bucket_name)
+    except botocore.exceptions.ClientError as e:
         if e.response["Error"]["Code"] == "403":
             alert(
                 (
                     f'Bucket "{bucket_name}" could not be retrieved with the specified '
                     f"credentials. Tried Access Key ID "
-                    f"{boto3.Session().get_credentials().access_key}"
+                    f"{(session or boto3.Session()).get_credentials().access_key}"
                 ),
                 os.EX_NOUSER,
             )
         else:
             raise e
 
+    # one listing up front answers "is this file already there?" for every
+    # upload and is reused to find orphans when deleting
+    remote_index = get_remote_index(s3_client, bucket_name, bucket_path, processes)
+
     files = determine_files_to_sync(local_path, excludes, gitignore=gitignore)
+    upload_kwargs = {
+        "acl": acl,
+        "force": force,
+        "dry_run": dry_run,
+        "charset": charset,
+        "caches": caches,
+        "content_headers": get_content_headers(caches, charset),
+        "remote_index": remote_index,
+    }
     deleted = 0
     key_names = []
     updated = 0
-    with get_progress_bar(
-        desc=f"{colorama.Fore.GREEN}Updating {env}{colorama.Style.RESET_ALL}",
-        total=len(files),
-    ) as bar:
-        with futures.ThreadPoolExecutor(max_workers=processes) as executor:
-            jobs = []
-            for fn in files:
-                job = executor.submit(
-                    upload_file,
-                    *(fn, bucket_name, s3, bucket_path, local_path),
-                    **{
-                        "acl": acl,
-                        "force": force,
-                        "dry_run": dry_run,
-                        "charset": charset,
-                        "caches": caches,
-                        "bar": bar,
-                    },
-                )
-                jobs.append(job)
-            for job in futures.as_completed(jobs):
-                key_names.append(job.result())
-            executor.shutdown(wait=True)
+    # every upload shares one transfer manager, so multipart uploads of large
+    # files split into parts without each file starting its own thread pool
+    with (
+        create_transfer_manager(
+            s3_client, get_transfer_config(processes)
+        ) as transfer_manager,
+        get_progress_bar(
+            desc=f"{colorama.Fore.GREEN}Updating {env}{RESET_COLOR}",
+            total=len(files),
+        ) as bar,
+    ):
+        upload_kwargs["transfer_manager"] = transfer_manager
+        upload_kwargs["bar"] = bar
+        key_names = run_jobs(
+            processes,
+            upload_file,
+            files,
+            *(bucket_name, s3_client, bucket_path, local_path),
+            **upload_kwargs,
+        )
 
     updated = sum([i[1] for i in key_names])
     key_names = [i[0] for i in key_names if i[0]]
 
     if delete and not killswitch.is_set():
+        synced_keys = set(key_names)
         to_remove = [
-            key.key
-            for key in bucket.objects.filter(Prefix=bucket_path.lstrip("/"))
-            if key.key.lstrip("/") not in key_names
+            key_name
+            for key_name in remote_index
+            if key_name.lstrip("/") not in synced_keys
         ]
         if len(to_remove):
             with get_progress_bar(
-                desc=f"{colorama.Fore.RED}Cleaning {env}{colorama.Style.RESET_ALL}",
+                desc=f"{colorama.Fore.RED}Cleaning {env}{RESET_COLOR}",
                 total=len(to_remove),
                 colour="RED",
             ) as bar:
-                deleted = 0
-                with futures.ThreadPoolExecutor(max_workers=processes) as executor:
-                    jobs = []
-                    for kn in to_remove:
-                        job = executor.submit(
-                            delete_file,
-                            *(kn, bucket_name, s3),
-                            **{
-                                "needs_confirmation": confirm,
-                                "bar": bar,
-                                "dry_run": dry_run,
-                            },
-                        )
-                        jobs.append(job)
-                    for job in futures.as_completed(jobs):
-                        deleted += job.result()
-                    executor.shutdown(wait=True)
+                if confirm:
+                    # prompts can't be answered in parallel, so ask about each
+                    # key in turn and remove the confirmed ones in batches
+                    confirmed = []
+                    for key_name in to_remove:
+                        if get_confirmation(
+                            f"\nRemove {bucket_name}/{key_name.lstrip('/')}"
+                        ):
+                            confirmed.append(key_name)
+                        else:
+                            alert(
+                                f"Skipping removal of "
+                                f"{bucket_name}/{key_name.lstrip('/')}",
+                            )
+                            bar.update()
+                    to_remove = confirmed
+                batches = [
+                    to_remove[i : i + DELETE_BATCH_SIZE]
+                    for i in range(0, len(to_remove), DELETE_BATCH_SIZE)
+                ]
+                deleted = sum(
+                    run_jobs(
+                        processes,
+                        delete_files,
+                        batches,
+                        *(bucket_name, s3_client),
+                        **{"bar": bar, "dry_run": dry_run},
+                    )
+                )
 
     verb = "would be" if dry_run else "were"
     outcome = {
@@ -551,18 +904,16 @@ def sync_files(
 
 
 def processes_int(x: typing.Union[str, int, float]) -> int:
-    x = int(x)
-    if x < 1 or x > 50:
-        raise argparse.ArgumentTypeError("An integer between 1 and 50 is required")
-    return x
+    if not isinstance(x, int):
+        x = int(x)
+    if 1 <= x <= 50:
+        return x
+    raise argparse.ArgumentTypeError("An integer between 1 and 50 is required")
 
 
-def cli():
-    global QUIET
-    if "-v" in sys.argv or "--version" in sys.argv:
-        # do this here before any of the config checks are run
-        alert(f"d3ploy {VERSION}", os.EX_OK, colorama.Fore.GREEN)
-
+# the parser is the same on every call, so it's only built once
+@functools.lru_cache(maxsize=1)
+def get_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "environment",
@@ -679,7 +1030,17 @@ def cli():
         action="store_true",
         default=False,
     )
-    args, unknown = parser.parse_known_args()
+    return parser
+
+
+def cli():
+    global QUIET
+    if "-v" in sys.argv or "--version" in sys.argv:
+        # do this here before the parser is built or any of the config checks
+        # are run
+        alert(f"d3ploy {VERSION}", os.EX_OK, colorama.Fore.GREEN)
+
+    args, unknown = get_parser().parse_known_args()
 
     if args.quiet:
         QUIET = True
@@ -697,9 +1058,11 @@ def cli():
     # load the config file
     config = {}
     config_path = pathlib.Path(args.config)
-    if config_path.exists():
-        config = json.loads(config_path.read_text())
-    else:
+    # read it straight away rather than checking it exists first, and let json
+    # decode the bytes itself
+    try:
+        config = json.loads(config_path.read_bytes())
+    except FileNotFoundError:
         alert(
             (
                 f"Config file is missing. Looked for {args.config}. "
@@ -738,11 +1101,8 @@ def cli():
 
     to_deploy = environments if args.all else args.environment
 
+    deployments = []
     for environ in to_deploy:
-        alert(
-            f"Uploading environment {to_deploy.index(environ) + 1:d} "
-            f"of {len(to_deploy):d}"
-        )
         environ_config = config["environments"][environ]
         if not environ_config.get("excludes", False):
             environ_config["excludes"] = []
@@ -750,52 +1110,98 @@ def cli():
             defaults["excludes"] = []
         excludes = []
         if args.exclude:
-            excludes = args.exclude
+            excludes = list(args.exclude)
         else:
             excludes = environ_config.get("exclude", []) + defaults.get("exclude", [])
         excludes.append(args.config)
-        sync_files(
-            environ,
-            bucket_name=args.bucket_name
-            or environ_config.get("bucket_name")
-            or defaults.get("bucket_name"),
-            local_path=args.local_path
-            or environ_config.get("local_path")
-            or defaults.get("local_path")
-            or ".",
-            bucket_path=args.bucket_path
-            or environ_config.get("bucket_path")
-            or defaults.get("bucket_path")
-            or "/",
-            excludes=excludes,
-            acl=args.acl or environ_config.get("acl") or defaults.get("acl"),
-            force=args.force or environ_config.get("force") or defaults.get("force"),
-            dry_run=args.dry_run,
-            charset=args.charset
-            or environ_config.get("charset")
-            or defaults.get("charset"),
-            gitignore=args.gitignore
-            or environ_config.get("gitignore")
-            or defaults.get("gitignore"),
-            processes=args.processes,
-            delete=args.delete
-            or environ_config.get("delete")
-            or defaults.get("delete"),
-            confirm=args.confirm,
-            cloudfront_id=args.cloudfront_id
-            or environ_config.get("cloudfront_id")
-            or defaults.get("cloudfront_id")
-            or [],
-            caches=environ_config.get("caches", {}) or defaults.get("caches", {}),
+        deployments.append(
+            functools.partial(
+                sync_files,
+                environ,
+                bucket_name=args.bucket_name
+                or environ_config.get("bucket_name")
+                or defaults.get("bucket_name"),
+                local_path=args.local_path
+                or environ_config.get("local_path")
+                or defaults.get("local_path")
+                or ".",
+                bucket_path=args.bucket_path
+                or environ_config.get("bucket_path")
+                or defaults.get("bucket_path")
+                or "/",
+                excludes=excludes,
+                acl=args.acl or environ_config.get("acl") or defaults.get("acl"),
+                force=args.force
+                or environ_config.get("force")
+                or defaults.get("force"),
+                dry_run=args.dry_run,
+                charset=args.charset
+                or environ_config.get("charset")
+                or defaults.get("charset"),
+                gitignore=args.gitignore
+                or environ_config.get("gitignore")
+                or defaults.get("gitignore"),
+                processes=args.processes,
+                delete=args.delete
+                or environ_config.get("delete")
+                or defaults.get("delete"),
+                confirm=args.confirm,
+                cloudfront_id=args.cloudfront_id
+                or environ_config.get("cloudfront_id")
+                or defaults.get("cloudfront_id")
+                or [],
+                caches=environ_config.get("caches", {}) or defaults.get("caches", {}),
+            )
         )
-        display_output()
 
+    if args.confirm or len(deployments) == 1:
+        # confirmation prompts read from stdin, so only one environment at a
+        # time can be asking
+        for i, deployment in enumerate(deployments):
+            alert(f"Uploading environment {i + 1:d} of {len(deployments):d}")
+            deployment()
+    else:
+        deploy_concurrently(deployments)
 
-if __name__ == "__main__":  # pragma: no cover
-    colorama_init()
+
+def deploy_environment(position: int, deployment: typing.Callable):
+    bar_position.value = position
+    return deployment()
+
+
+def deploy_concurrently(deployments: typing.List[typing.Callable]):
+    alert(f"Uploading {len(deployments):d} environments at the same time")
+    executor = futures.ThreadPoolExecutor(max_workers=len(deployments))
+    try:
+        jobs = [
+            executor.submit(deploy_environment, i, deployment)
+            for i, deployment in enumerate(deployments)
+        ]
+        for job in futures.as_completed(jobs):
+            job.result()
+    except BaseException:
+        # one environment failing (including an alert's SystemExit) stops the
+        # uploads and deletes still running for the others
+        killswitch.set()
+        raise
+    finally:
+        executor.shutdown(cancel_futures=True)
+        killswitch.clear()
+
+
+def check_for_updates_in_background():  # pragma: no cover
     try:
         check_for_updates()
     except Exception as e:
         if os.environ.get("D3PLOY_DEBUG") == "True":
             raise e
+
+
+if __name__ == "__main__":  # pragma: no cover
+    colorama_init()
+    # the sync doesn't need to wait on PyPI, so check for updates alongside it
+    # and give an unfinished check a moment to report before exiting
+    update_check = threading.Thread(target=check_for_updates_in_background, daemon=True)
+    update_check.start()
+    atexit.register(update_check.join, 0.5)
     cli()
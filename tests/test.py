@@ -1,21 +1,29 @@
 import argparse
 import contextlib
+import functools
 import io
 import json
 import os
 import pathlib
-import re
 import shutil
 import sys
+import threading
 import time
+import typing
 import unittest
 import uuid
 import warnings
+from concurrent import futures
 from unittest.mock import Mock
 from unittest.mock import patch
 
 import boto3
+import botocore.config
+import botocore.exceptions
 import colorama
+import moto
+import pathspec
+import pytest
 
 parent_dir = pathlib.Path(__file__).parent.parent.absolute()
 tests_dir = parent_dir / "tests"
@@ -25,46 +33,30 @@ sys.path.append(str(parent_dir))
 from d3ploy import d3ploy  # noqa # isort:skip
 
 TEST_BUCKET = os.getenv("D3PLOY_TEST_BUCKET", "d3ploy-tests")
-TEST_CLOUDFRONT_DISTRIBUTION = os.getenv(
-    "D3PLOY_TEST_CLOUDFRONT_DISTRIBUTION",
-    "ECVGU5V5GT5GO",
+EXCLUDES = [".gitignore", ".gitkeep"]
+IGNORED_FILES = ["ignore.js", "please.ignoreme", "test.ignore"]
+
+
+# the fixture lists come from the tree itself, so adding a fixture file doesn't
+# mean updating them by hand; they're only compared, never opened, so pure paths
+# are enough
+def walk_test_files(path: pathlib.Path) -> typing.Iterator[pathlib.PurePath]:
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in [".git", ".svn"]:
+                    yield from walk_test_files(entry.path)
+            elif entry.name not in EXCLUDES:
+                yield pathlib.PurePath(os.path.relpath(entry.path, parent_dir))
+
+
+# compared as sets, so they're kept in walk order
+TEST_FILES_WITH_IGNORED_FILES = tuple(walk_test_files(tests_dir / "files"))
+TEST_FILES = tuple(
+    x for x in TEST_FILES_WITH_IGNORED_FILES if x.name not in IGNORED_FILES
 )
-TEST_FILES = [
-    "tests/files/.d3ploy.json",
-    "tests/files/.empty-config.json",
-    "tests/files/.test-d3ploy",
-    "tests/files/css/sample.css",
-    "tests/files/dont.ignoreme",
-    "tests/files/fonts/open-sans.eot",
-    "tests/files/fonts/open-sans.svg",
-    "tests/files/fonts/open-sans.ttf",
-    "tests/files/fonts/open-sans.woff",
-    "tests/files/fonts/open-sans.woff2",
-    "tests/files/html/index.html",
-    "tests/files/img/32d08f4a5eb10332506ebedbb9bc7257.jpg",
-    "tests/files/img/40bb78b1ac031125a6d8466b374962a8.jpg",
-    "tests/files/img/6c853ed9dacd5716bc54eb59cec30889.png",
-    "tests/files/img/6d939393058de0579fca1bbf10ecff25.gif",
-    "tests/files/img/9540743374e1fdb273b6a6ca625eb7a3.png",
-    "tests/files/img/c-m1-4bdd87fd0324f0a3d84d6905d17e1731.png",
-    "tests/files/img/d22db5be7594c17a18a047ca9264ea0a.jpg",
-    "tests/files/img/e6aa0c45a13dd7fc94f7b5451bd89bf4.gif",
-    "tests/files/img/f617c7af7f36296a37ddb419b828099c.gif",
-    "tests/files/img/http.svg",
-    "tests/files/js/sample.js",
-    "tests/files/js/sample.mjs",
-    "tests/files/sample.json",
-    "tests/files/sample.xml",
-]
-TEST_FILES_WITH_IGNORED_FILES = TEST_FILES + [
-    "tests/files/js/ignore.js",
-    "tests/files/please.ignoreme",
-    "tests/files/test.ignore",
-]
-TEST_FILES.sort()
-TEST_FILES = [pathlib.Path(x) for x in TEST_FILES]
-TEST_FILES_WITH_IGNORED_FILES.sort()
-TEST_FILES_WITH_IGNORED_FILES = [pathlib.Path(x) for x in TEST_FILES_WITH_IGNORED_FILES]
+# the keys TEST_FILES end up under when tests/files is synced
+TEST_KEYS = tuple(x.relative_to("tests/files").as_posix() for x in TEST_FILES)
 TEST_MIMETYPES = [
     ("css/sample.css", "text/css"),
     ("fonts/open-sans.eot", "application/vnd.ms-fontobject"),
@@ -119,61 +111,202 @@ ACL_GRANTS = {
         }
     ],
 }
-EXCLUDES = [".gitignore", ".gitkeep"]
+# moto stores public-read-write with only the READ grant, so the WRITE grant
+# can't be checked against the mock
+UNMOCKED_ACLS = ["public-read-write"]
 CHARSETS = [None, "UTF-8", "ISO-8859-1", "Windows-1251"]
+EXPIRATIONS = [0, 86400, 86400 * 30, 86400 * 365]
+
+
+warnings.simplefilter("ignore", ResourceWarning)
+
+# every S3 and CloudFront call is answered in-process by moto, so the suite
+# needs no AWS account and each pytest-xdist worker gets its own bucket; the
+# mock has to be running before the shared resource below resolves credentials
+MOCK_AWS = moto.mock_aws()
+MOCK_AWS.start()
+
+# building a resource loads the service model and a new connection pool, so the
+# whole module shares one, sized for the sync tests that pass its client to
+# sync_files with processes=10
+S3 = boto3.resource(
+    "s3",
+    config=botocore.config.Config(
+        max_pool_connections=50,
+        tcp_keepalive=True,
+        retries={"mode": "adaptive", "max_attempts": 3},
+    ),
+)
+S3_CLIENT = S3.meta.client
+S3_CLIENT.create_bucket(Bucket=TEST_BUCKET)
+TEST_CLOUDFRONT_DISTRIBUTION = boto3.client("cloudfront").create_distribution(
+    DistributionConfig={
+        "CallerReference": TEST_BUCKET,
+        "Comment": "",
+        "Enabled": True,
+        "Origins": {
+            "Quantity": 1,
+            "Items": [
+                {
+                    "Id": TEST_BUCKET,
+                    "DomainName": f"{TEST_BUCKET}.s3.amazonaws.com",
+                    "S3OriginConfig": {"OriginAccessIdentity": ""},
+                }
+            ],
+        },
+        "DefaultCacheBehavior": {
+            "TargetOriginId": TEST_BUCKET,
+            "ViewerProtocolPolicy": "allow-all",
+            "MinTTL": 0,
+        },
+    }
+)["Distribution"]["Id"]
+
 
+def tearDownModule():
+    MOCK_AWS.stop()
 
+
+# a key sorts before everything else it prefixes, so listing one key is enough
+# and a missing key doesn't go through a 404 ClientError
 def s3_object_exists(bucket_name: str, key_name: str) -> bool:
-    warnings.simplefilter("ignore", ResourceWarning)
-    s3 = boto3.resource("s3")
-    return d3ploy.key_exists(s3, bucket_name, key_name)
+    response = S3_CLIENT.list_objects_v2(
+        Bucket=bucket_name,
+        Prefix=key_name,
+        MaxKeys=1,
+    )
+    return any(x["Key"] == key_name for x in response.get("Contents", []))
+
+
+def list_prefix(bucket_name: str, prefix: str) -> typing.Set[str]:
+    return set(d3ploy.get_remote_index(S3_CLIENT, bucket_name, prefix))
 
 
+def s3_object_grants(bucket_name: str, key_name: str) -> typing.List[typing.Dict]:
+    response = S3_CLIENT.get_object_acl(Bucket=bucket_name, Key=key_name)
+    return [
+        grant
+        for grant in response["Grants"]
+        # skip the individual user permissions
+        if grant.get("Grantee", {}).get("Type") != "CanonicalUser"
+    ]
+
+
+# paths are immutable, so the same handful of fixture paths can be reused
+@functools.lru_cache(maxsize=None)
 def relative_path(p: str) -> pathlib.Path:
     relpath = pathlib.Path(parent_dir, "tests", p)
     return relpath
 
 
-PREFIX_REGEX = re.compile(r"^{}".format(relative_path("./files")))
-PREFIX_PATH = pathlib.Path(relative_path("./files"))
+# compare file lists as plain strings; the order determine_files_to_sync returns
+# them in doesn't matter
+def relative_names(paths: typing.Iterable[os.PathLike]) -> typing.Set[str]:
+    return {os.path.relpath(x, parent_dir) for x in paths}
+
+
+# fixture directories are built once; they aren't resolved so they stay
+# prefixes of the paths walked from them
+FILES_ROOT = relative_path("./files")
+CSS_ROOT = FILES_ROOT / "css"
+HTML_ROOT = FILES_ROOT / "html"
+TXT_ROOT = FILES_ROOT / "txt"
+PREFIX_PATH = FILES_ROOT
+SAMPLE_CSS = CSS_ROOT / "sample.css"
+INDEX_HTML = HTML_ROOT / "index.html"
 
 
 # we need to remove .DS_Store files before testing on macOS to keep tests consistent on
 # other platforms
 def clean_ds_store():
-    for _path in pathlib.Path(relative_path("./")).rglob(".DS_Store"):
-        _path.unlink()
+    # walk_files reuses the type information from scandir, so this doesn't stat
+    # or build a Path for every file in the tree like rglob does
+    for entry in d3ploy.walk_files(relative_path("./")):
+        if entry.name == ".DS_Store":
+            os.unlink(entry.path)
 
 
-class BaseTestCase(unittest.TestCase):
-    def setUp(self):
+def setUpModule():
+    # nothing in the suite creates .DS_Store files, so one sweep is enough, and
+    # only the macOS Finder makes them in the first place
+    if sys.platform == "darwin":
         clean_ds_store()
-        super().setUp()
+
+
+# test cases that share the test bucket or write into tests/files run on the
+# same pytest-xdist worker, everything else is spread across the others
+shares_fixtures = pytest.mark.xdist_group("fixtures")
+
+
+class BaseTestCase(unittest.TestCase):
+    pass
 
 
 class S3BucketMixin(unittest.TestCase):
+    # set whenever the shared client writes to the bucket (see mark_bucket_dirty
+    # below), so the bucket is only listed and emptied after tests that wrote
+    dirty = True
+
     @classmethod
     def setUpClass(cls):
-        cls.s3 = boto3.resource("s3")
+        cls.s3 = S3
+        cls.s3_client = S3_CLIENT
         cls.bucket = cls.s3.Bucket(TEST_BUCKET)
         super().setUpClass()
 
+    @classmethod
+    def empty_bucket(cls):
+        if not S3BucketMixin.dirty:
+            return
+        # most tests leave only a few keys behind, so list a page at a time and
+        # skip the delete call entirely when there's nothing to remove
+        paginator = cls.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=TEST_BUCKET):
+            if page.get("KeyCount", 0):
+                cls.s3_client.delete_objects(
+                    Bucket=TEST_BUCKET,
+                    Delete={
+                        "Objects": [{"Key": x["Key"]} for x in page["Contents"]],
+                        "Quiet": True,
+                    },
+                )
+        S3BucketMixin.dirty = False
+
     def setUp(self):
-        self.bucket.objects.all().delete()  # clean out the bucket before each test
+        self.empty_bucket()  # clean out the bucket before each test
         super().setUp()
 
     @classmethod
     def tearDownClass(cls):
-        cls.bucket.objects.all().delete()  # clean out the bucket after all tests
+        cls.empty_bucket()  # clean out the bucket after all tests
         super().tearDownClass()
 
 
+def mark_bucket_dirty(**kwargs):
+    S3BucketMixin.dirty = True
+
+
+def track_bucket_writes(events):
+    for operation in ["PutObject", "CopyObject", "CreateMultipartUpload"]:
+        events.register(f"before-call.s3.{operation}", mark_bucket_dirty)
+
+
+track_bucket_writes(S3_CLIENT.meta.events)
+
+
+# stands in for boto3.session.Session in tests where sync_files builds its own
+# client, so that client's writes mark the bucket dirty too; boto3.Session is the
+# same class under a name the patch leaves alone
+def tracked_session(*args, **kwargs):
+    session = boto3.Session(*args, **kwargs)
+    track_bucket_writes(session.events)
+    return session
+
+
 class TestFileMixin(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        cls.test_file_name = (
-            relative_path("./files/txt") / f"test-{uuid.uuid4().hex}.txt"
-        )
+        cls.test_file_name = TXT_ROOT / f"test-{uuid.uuid4().hex}.txt"
 
         cls.destroy_test_file()
         super().setUpClass()
@@ -191,23 +324,21 @@ class TestFileMixin(unittest.TestCase):
         cls.destroy_test_file()
         super().tearDownClass()
 
-    def create_test_file(self):
-        with open(self.test_file_name, "w") as f:
-            f.write(uuid.uuid4().hex + "\n")
-            f.flush()
-            f.close()
-
     @classmethod
     def destroy_test_file(cls):
-        if cls.test_file_name.exists():
-            cls.test_file_name.unlink()
+        cls.test_file_name.unlink(missing_ok=True)
 
 
 class MockBuffer:
-    value = ""
+    def __init__(self):
+        self.chunks = []
+
+    @property
+    def value(self):
+        return "".join(self.chunks)
 
     def write(self, string):
-        self.value += string
+        self.chunks.append(string)
 
     def flush(self):
         pass
@@ -216,13 +347,6 @@ class MockBuffer:
         return self.value
 
 
-class MockSyncFiles(Mock):
-    def __call__(self, env, **kwargs):
-        self.configure_mock(env=env)
-        # print(kwargs)
-        self.configure_mock(**kwargs)
-
-
 class AlertTestCase(BaseTestCase):
     def test_non_error_alerts(self):
         for color in [
@@ -230,25 +354,23 @@ class AlertTestCase(BaseTestCase):
             colorama.Fore.RED,
             colorama.Fore.YELLOW,
         ]:
-            d3ploy.alert(
-                "Testing alert colors",
-                color=color,
-            )
+            std_out = io.StringIO()
+            with contextlib.redirect_stdout(std_out):
+                d3ploy.alert(
+                    "Testing alert colors",
+                    color=color,
+                )
             self.assertEqual(
-                d3ploy.OUTPUT.pop()[0],
-                f"{color}Testing alert colors{colorama.Style.RESET_ALL}",
+                std_out.getvalue(),
+                f"{color}Testing alert colors{colorama.Style.RESET_ALL}\n",
             )
 
+    @patch("d3ploy.d3ploy.QUIET", True)
     def test_non_error_alerts_quieted(self):
-        d3ploy.QUIET = True
-        std_out = io.StringIO()
-        with contextlib.redirect_stdout(std_out):
+        # nothing should reach the writer at all, so there's no output to capture
+        with patch("d3ploy.d3ploy.tqdm.write") as write:
             d3ploy.alert("Testing alert colors")
-        self.assertEqual(
-            std_out.getvalue(),
-            "",
-        )
-        d3ploy.QUIET = False
+        write.assert_not_called()
 
     def test_error_alerts(self):
         with self.assertRaises(SystemExit) as exception:
@@ -277,6 +399,7 @@ class AlertTestCase(BaseTestCase):
             )
 
 
+@shares_fixtures
 class DetermineFilesToSyncTestCase(BaseTestCase):
     @classmethod
     def setUpClass(cls):
@@ -284,35 +407,32 @@ class DetermineFilesToSyncTestCase(BaseTestCase):
 
     def test_no_excludes(self):
         files_list = d3ploy.determine_files_to_sync(
-            relative_path("./files/txt"),
+            TXT_ROOT,
             None,
             gitignore=False,
         )
-        files_list = [x.relative_to(parent_dir) for x in files_list]
-        files_list.sort()
-        self.assertListEqual(
-            files_list, [relative_path("./files/txt/.gitkeep").relative_to(parent_dir)]
+        self.assertSetEqual(
+            relative_names(files_list),
+            {os.path.join("tests", "files", "txt", ".gitkeep")},
         )
 
     def test_no_gitignore(self):
         files_list = d3ploy.determine_files_to_sync(
-            relative_path("./files"),
+            FILES_ROOT,
             EXCLUDES,
             gitignore=False,
         )
-        files_list = [x.relative_to(parent_dir) for x in files_list]
-        files_list.sort()
-        self.assertListEqual(files_list, TEST_FILES_WITH_IGNORED_FILES)
+        self.assertSetEqual(
+            relative_names(files_list), relative_names(TEST_FILES_WITH_IGNORED_FILES)
+        )
 
     def test_with_gitignore(self):
         files_list = d3ploy.determine_files_to_sync(
-            relative_path("./files"),
+            FILES_ROOT,
             EXCLUDES,
             gitignore=True,
         )
-        files_list = [x.relative_to(parent_dir) for x in files_list]
-        files_list.sort()
-        self.assertListEqual(files_list, TEST_FILES)
+        self.assertSetEqual(relative_names(files_list), relative_names(TEST_FILES))
 
     def test_single_file_path_no_gitignore(self):
         files_list = d3ploy.determine_files_to_sync(
@@ -320,10 +440,9 @@ class DetermineFilesToSyncTestCase(BaseTestCase):
             EXCLUDES,
             gitignore=False,
         )
-        files_list = [x.relative_to(parent_dir) for x in files_list]
-        self.assertListEqual(
-            files_list,
-            [relative_path("./files/test.ignore").relative_to(parent_dir)],
+        self.assertSetEqual(
+            relative_names(files_list),
+            {os.path.join("tests", "files", "test.ignore")},
         )
 
     def test_single_file_path_with_gitignore(self):
@@ -339,63 +458,90 @@ class DetermineFilesToSyncTestCase(BaseTestCase):
 
     def test_ignored_paths_list(self):
         files_list = d3ploy.determine_files_to_sync(
-            relative_path("./files"),
+            FILES_ROOT,
             EXCLUDES + ["index.html"],
         )
-        files_list = [x.relative_to(parent_dir) for x in files_list]
-        expected = [
-            x for x in TEST_FILES_WITH_IGNORED_FILES if not x.match("*/index.html")
-        ]
-        expected.sort()
-        files_list.sort()
-        self.assertListEqual(
-            files_list,
-            expected,
+        expected = relative_names(
+            x for x in TEST_FILES_WITH_IGNORED_FILES if x.name != "index.html"
+        )
+        self.assertSetEqual(relative_names(files_list), expected)
+
+    def test_ignored_directory_is_not_walked(self):
+        with patch("d3ploy.d3ploy.walk_files", wraps=d3ploy.walk_files) as walk_files:
+            files_list = d3ploy.determine_files_to_sync(
+                FILES_ROOT,
+                EXCLUDES + ["css/"],
+            )
+        self.assertNotIn(
+            str(CSS_ROOT),
+            [call.args[0] for call in walk_files.call_args_list],
+        )
+        self.assertNotIn(SAMPLE_CSS, files_list)
+
+    def test_negated_pattern_in_ignored_directory(self):
+        files_list = d3ploy.determine_files_to_sync(
+            FILES_ROOT,
+            EXCLUDES + ["css/", "!sample.css"],
         )
+        self.assertIn(SAMPLE_CSS, files_list)
+
+    def test_negated_pattern_in_nested_gitignore(self):
+        cwd = "{}".format(os.getcwd())
+        os.chdir(TXT_ROOT)
+        std_out = io.StringIO()
+        with contextlib.redirect_stdout(std_out):
+            files_list = d3ploy.determine_files_to_sync(
+                FILES_ROOT,
+                EXCLUDES + ["js/"],
+                gitignore=True,
+            )
+        os.chdir(cwd)
+        self.assertIn(FILES_ROOT / "js" / "sample.js", files_list)
+        self.assertNotIn(FILES_ROOT / "js" / "ignore.js", files_list)
+        self.assertNotIn(FILES_ROOT / "js" / "sample.mjs", files_list)
+        self.assertNotIn("no .gitignore files were found", std_out.getvalue())
 
     def test_ignored_paths_string(self):
         files_list = d3ploy.determine_files_to_sync(
-            relative_path("./files"),
+            FILES_ROOT,
             "index.html",
         )
         self.assertNotIn(
-            relative_path("./files/html/index.html"),
+            INDEX_HTML,
             files_list,
         )
 
     def test_ignored_paths_string_with_str_path(self):
         files_list = d3ploy.determine_files_to_sync(
-            str(relative_path("./files")),
+            str(FILES_ROOT),
             "index.html",
         )
         self.assertNotIn(
-            relative_path("./files/html/index.html"),
+            INDEX_HTML,
             files_list,
         )
 
     def test_gitignore_files_not_found(self):
         cwd = "{}".format(os.getcwd())
-        os.chdir(relative_path("./files/txt"))
-        d3ploy.determine_files_to_sync(
-            relative_path("./files/txt"),
-            EXCLUDES,
-            gitignore=True,
-        )
+        os.chdir(TXT_ROOT)
+        std_out = io.StringIO()
+        with contextlib.redirect_stdout(std_out):
+            d3ploy.determine_files_to_sync(
+                TXT_ROOT,
+                EXCLUDES,
+                gitignore=True,
+            )
         self.assertIn(
             "no .gitignore files were found",
-            d3ploy.OUTPUT[-1][0],
+            std_out.getvalue(),
         )
         os.chdir(cwd)
 
 
+@shares_fixtures
 class CheckForUpdatesTestCase(BaseTestCase, TestFileMixin):
-    def setUp(self):
-        time.sleep(0.5)
-        super().setUp()
-
     def test_no_existing_file(self):
-        if self.test_file_name.exists():
-            self.test_file_name.unlink()
+        self.test_file_name.unlink(missing_ok=True)
         result = d3ploy.check_for_updates(self.test_file_name)
         self.assertFalse(
             result,
@@ -405,10 +551,7 @@ class CheckForUpdatesTestCase(BaseTestCase, TestFileMixin):
         )
 
     def test_existing_recent_check(self):
-        with open(self.test_file_name, "w") as f:
-            f.write("{:d}".format(int(time.time()) - 300))
-            f.flush()
-            f.close()
+        self.test_file_name.write_text("{:d}".format(int(time.time()) - 300))
         result = d3ploy.check_for_updates(self.test_file_name)
         self.assertIsNone(
             result,
@@ -416,10 +559,7 @@ class CheckForUpdatesTestCase(BaseTestCase, TestFileMixin):
         )
 
     def test_existing_old_check(self):
-        with open(self.test_file_name, "w") as f:
-            f.write("{:d}".format(int(time.time()) - 100000))
-            f.flush()
-            f.close()
+        self.test_file_name.write_text("{:d}".format(int(time.time()) - 100000))
         result = d3ploy.check_for_updates(self.test_file_name)
         self.assertIn(
             result,
@@ -467,6 +607,7 @@ class CheckForUpdatesTestCase(BaseTestCase, TestFileMixin):
             )
 
 
+@shares_fixtures
 class UploadFileTestCase(
     BaseTestCase,
     S3BucketMixin,
@@ -475,9 +616,9 @@ class UploadFileTestCase(
     def test_bucket_path(self):
         for prefix in ["test", "testing"]:
             result = d3ploy.upload_file(
-                relative_path("./files/css/sample.css"),
+                SAMPLE_CSS,
                 self.bucket.name,
-                self.s3,
+                self.s3_client,
                 prefix,
                 PREFIX_PATH,
             )
@@ -494,9 +635,9 @@ class UploadFileTestCase(
 
     def test_with_path_as_str(self):
         result = d3ploy.upload_file(
-            str(relative_path("./files/css/sample.css")),
+            str(SAMPLE_CSS),
             self.bucket.name,
-            self.s3,
+            self.s3_client,
             "test",
             PREFIX_PATH,
         )
@@ -511,40 +652,58 @@ class UploadFileTestCase(
             msg="upload_file returns the correct status",
         )
 
-    def test_acls(self):
+    def test_with_unnormalized_prefix(self):
+        result = d3ploy.upload_file(
+            SAMPLE_CSS,
+            self.bucket.name,
+            self.s3_client,
+            "test",
+            f"{FILES_ROOT}/./",
+        )
+        self.assertEqual(
+            result[0],
+            "test/css/sample.css",
+            msg="upload_file returns the correct path",
+        )
+
+    def assert_acl(self, acl: str):
+        if acl in UNMOCKED_ACLS:
+            self.skipTest("{} grants aren't reported by moto".format(acl))
+        result = d3ploy.upload_file(
+            SAMPLE_CSS,
+            self.bucket.name,
+            self.s3_client,
+            "test-acl-{}".format(acl),
+            PREFIX_PATH,
+            acl=acl,
+        )
+        self.assertListEqual(
+            s3_object_grants(self.bucket.name, result[0]),
+            ACL_GRANTS.get(acl),
+            msg="upload_file sets the correct ACL grants for ACL {}".format(acl),
+        )
+
+    def test_acl_smoke(self):
+        self.assert_acl("public-read")
+
+    @pytest.mark.slow
+    def test_acls_exhaustive(self):
         for acl in d3ploy.VALID_ACLS:
-            result = d3ploy.upload_file(
-                relative_path("./files/css/sample.css"),
-                self.bucket.name,
-                self.s3,
-                "test-acl-{}".format(acl),
-                PREFIX_PATH,
-                acl=acl,
-            )
-            object_acl = self.s3.ObjectAcl(self.bucket.name, result[0])
-            grants = []
-            for grant in object_acl.grants:
-                if grant.get("Grantee", {}).get("Type") == "CanonicalUser":
-                    continue  # skip the individual user permissions
-                grants.append(grant)
-            self.assertListEqual(
-                grants,
-                ACL_GRANTS.get(acl),
-                msg="upload_file sets the correct ACL grants for ACL {}".format(acl),
-            )
+            with self.subTest(acl=acl):
+                self.assert_acl(acl)
 
     def test_force_update_file(self):
         d3ploy.upload_file(
-            relative_path("./files/css/sample.css"),
+            SAMPLE_CSS,
             self.bucket.name,
-            self.s3,
+            self.s3_client,
             "test-force-upload",
             PREFIX_PATH,
         )
         result = d3ploy.upload_file(
-            relative_path("./files/css/sample.css"),
+            SAMPLE_CSS,
             self.bucket.name,
-            self.s3,
+            self.s3_client,
             "test-force-upload",
             PREFIX_PATH,
             force=True,
@@ -554,22 +713,148 @@ class UploadFileTestCase(
             msg="upload_file force=True overwrites existing file",
         )
 
+    def test_remote_index(self):
+        result = d3ploy.upload_file(
+            SAMPLE_CSS,
+            self.bucket.name,
+            self.s3_client,
+            "test-remote-index",
+            PREFIX_PATH,
+        )
+        remote_index = d3ploy.get_remote_index(
+            self.s3_client,
+            self.bucket.name,
+            "test-remote-index",
+        )
+        self.assertIn(result[0], remote_index)
+        result = d3ploy.upload_file(
+            SAMPLE_CSS,
+            self.bucket.name,
+            self.s3_client,
+            "test-remote-index",
+            PREFIX_PATH,
+            remote_index=remote_index,
+        )
+        self.assertEqual(
+            result[1],
+            0,
+            msg="upload_file skips files listed in the remote index",
+        )
+        result = d3ploy.upload_file(
+            SAMPLE_CSS,
+            self.bucket.name,
+            self.s3_client,
+            "test-remote-index",
+            PREFIX_PATH,
+            remote_index={},
+        )
+        self.assertEqual(
+            result[1],
+            1,
+            msg="upload_file uploads files missing from the remote index",
+        )
+
+    def test_etag_matches_hash(self):
+        result = d3ploy.upload_file(
+            SAMPLE_CSS,
+            self.bucket.name,
+            self.s3_client,
+            "test-etag",
+            PREFIX_PATH,
+        )
+        s3_obj = self.s3.Object(self.bucket.name, result[0])
+        self.assertEqual(
+            s3_obj.e_tag.strip('"'),
+            s3_obj.metadata.get("d3ploy-hash"),
+            msg="upload_file sends small files in one request",
+        )
+
+    def test_large_file(self):
+        with open(self.test_file_name, "wb") as f:
+            f.truncate(d3ploy.MULTIPART_THRESHOLD + 1)
+        result = d3ploy.upload_file(
+            self.test_file_name,
+            self.bucket.name,
+            self.s3_client,
+            "test-large-file",
+            PREFIX_PATH,
+        )
+        # a multipart ETag ends in the part count, and one byte over the
+        # threshold only fits in two parts if the transfer config's chunk size
+        # made it through to s3transfer
+        self.assertTrue(
+            self.s3.Object(self.bucket.name, result[0]).e_tag.strip('"').endswith("-2"),
+            msg="upload_file uses multipart uploads for large files",
+        )
+
+    def test_large_file_untouched(self):
+        with open(self.test_file_name, "wb") as f:
+            f.truncate(d3ploy.MULTIPART_THRESHOLD + 1)
+        d3ploy.upload_file(
+            self.test_file_name,
+            self.bucket.name,
+            self.s3_client,
+            "test-large-file-untouched",
+            PREFIX_PATH,
+        )
+        # as if the file was last written well before it was uploaded
+        an_hour_ago = time.time() - 3600
+        os.utime(self.test_file_name, (an_hour_ago, an_hour_ago))
+        bar = Mock()
+        with patch("hashlib.file_digest") as file_digest:
+            result = d3ploy.upload_file(
+                self.test_file_name,
+                self.bucket.name,
+                self.s3_client,
+                "test-large-file-untouched",
+                PREFIX_PATH,
+                bar=bar,
+            )
+        self.assertEqual(
+            result[1],
+            0,
+            msg="upload_file skips large files not modified since they were uploaded",
+        )
+        file_digest.assert_not_called()
+        bar.update.assert_called_once_with()
+
+    def test_size_changed(self):
+        self.test_file_name.write_text("a")
+        d3ploy.upload_file(
+            self.test_file_name,
+            self.bucket.name,
+            self.s3_client,
+            "test-size-changed",
+            PREFIX_PATH,
+        )
+        self.test_file_name.write_text("ab")
+        result = d3ploy.upload_file(
+            self.test_file_name,
+            self.bucket.name,
+            self.s3_client,
+            "test-size-changed",
+            PREFIX_PATH,
+        )
+        self.assertEqual(
+            result[1],
+            1,
+            msg="upload_file uploads a file whose size changed",
+        )
+
     def test_md5_hashing(self):
-        with open(self.test_file_name, "w") as f:
-            f.write(uuid.uuid4().hex)
-            f.write("\n")
-            f.flush()
+        self.test_file_name.write_text(uuid.uuid4().hex + "\n")
         result_1 = d3ploy.upload_file(
             self.test_file_name,
             self.bucket.name,
-            self.s3,
+            self.s3_client,
             "test-md5-hashing",
             PREFIX_PATH,
         )
-        self.assertTrue(s3_object_exists(self.bucket.name, result_1[0]))
-        s3_object_1_hash = self.s3.Object(self.bucket.name, result_1[0]).metadata.get(
-            "d3ploy-hash"
+        s3_object_1 = d3ploy.get_object_head(
+            self.s3_client, self.bucket.name, result_1[0]
         )
+        self.assertIsNotNone(s3_object_1)
+        s3_object_1_hash = s3_object_1["Metadata"].get("d3ploy-hash")
         self.assertEqual(
             result_1[1],
             1,
@@ -578,14 +863,15 @@ class UploadFileTestCase(
         result_2 = d3ploy.upload_file(
             self.test_file_name,
             self.bucket.name,
-            self.s3,
+            self.s3_client,
             "test-md5-hashing",
             PREFIX_PATH,
         )
-        self.assertTrue(s3_object_exists(self.bucket.name, result_2[0]))
-        s3_object_2_hash = self.s3.Object(self.bucket.name, result_2[0]).metadata.get(
-            "d3ploy-hash"
+        s3_object_2 = d3ploy.get_object_head(
+            self.s3_client, self.bucket.name, result_2[0]
         )
+        self.assertIsNotNone(s3_object_2)
+        s3_object_2_hash = s3_object_2["Metadata"].get("d3ploy-hash")
         self.assertEqual(
             result_2[1],
             0,
@@ -596,20 +882,18 @@ class UploadFileTestCase(
             s3_object_2_hash,
             msg="upload_file hashes match for original and unchanged file",
         )
-        with open(self.test_file_name, "w") as f:
-            f.write(uuid.uuid4().hex)
-            f.write("\n")
-            f.flush()
+        self.test_file_name.write_text(uuid.uuid4().hex + "\n")
         result_3 = d3ploy.upload_file(
             self.test_file_name,
             self.bucket.name,
-            self.s3,
+            self.s3_client,
             "test-md5-hashing",
             PREFIX_PATH,
         )
-        s3_object_3_hash = self.s3.Object(self.bucket.name, result_3[0]).metadata.get(
-            "d3ploy-hash"
+        s3_object_3 = d3ploy.get_object_head(
+            self.s3_client, self.bucket.name, result_3[0]
         )
+        s3_object_3_hash = s3_object_3["Metadata"].get("d3ploy-hash")
         self.assertEqual(
             result_3[1],
             1,
@@ -623,9 +907,9 @@ class UploadFileTestCase(
 
     def test_dry_run(self):
         result = d3ploy.upload_file(
-            relative_path("./files/css/sample.css"),
+            SAMPLE_CSS,
             self.bucket.name,
-            self.s3,
+            self.s3_client,
             "test-dry-run",
             PREFIX_PATH,
             dry_run=True,
@@ -640,207 +924,172 @@ class UploadFileTestCase(
         )
 
     def test_charset(self):
-        for charset in CHARSETS:
-            result = d3ploy.upload_file(
-                relative_path("./files/html/index.html"),
-                self.bucket.name,
-                self.s3,
-                "test-charset-{}".format(charset),
-                PREFIX_PATH,
-                charset=charset,
+        with futures.ThreadPoolExecutor(max_workers=len(CHARSETS)) as executor:
+            results = executor.map(
+                lambda charset: d3ploy.upload_file(
+                    INDEX_HTML,
+                    self.bucket.name,
+                    self.s3_client,
+                    "test-charset-{}".format(charset),
+                    PREFIX_PATH,
+                    charset=charset,
+                ),
+                CHARSETS,
             )
-            s3_obj = self.s3.Object(self.bucket.name, result[0])
-            if charset:
-                self.assertEqual(
-                    s3_obj.content_type,
-                    "text/html;charset={}".format(charset),
-                )
-            else:
-                self.assertEqual(
-                    s3_obj.content_type,
-                    "text/html",
-                )
+        for charset, result in zip(CHARSETS, results):
+            with self.subTest(charset=charset):
+                s3_obj = self.s3.Object(self.bucket.name, result[0])
+                if charset:
+                    self.assertEqual(
+                        s3_obj.content_type,
+                        "text/html;charset={}".format(charset),
+                    )
+                else:
+                    self.assertEqual(
+                        s3_obj.content_type,
+                        "text/html",
+                    )
 
     def test_caches(self):
-        for expiration in [0, 86400, 86400 * 30, 86400 * 365]:
-            response = d3ploy.upload_file(
-                relative_path("./files/css/sample.css"),
-                self.bucket.name,
-                self.s3,
-                "test-cache-{:d}".format(expiration),
-                PREFIX_PATH,
-                caches={"text/css": expiration},
+        with futures.ThreadPoolExecutor(max_workers=len(EXPIRATIONS)) as executor:
+            responses = executor.map(
+                lambda expiration: d3ploy.upload_file(
+                    SAMPLE_CSS,
+                    self.bucket.name,
+                    self.s3_client,
+                    "test-cache-{:d}".format(expiration),
+                    PREFIX_PATH,
+                    caches={"text/css": expiration},
+                ),
+                EXPIRATIONS,
             )
-            s3_obj = self.s3.Object(self.bucket.name, response[0])
-            if expiration == 0:
-                self.assertEqual(
-                    s3_obj.cache_control,
-                    "max-age={:d}, private".format(expiration),
-                    msg=(
-                        f"upload_file sets proper cache-control header for "
-                        f"max-age={expiration:d}"
-                    ),
-                )
-            else:
-                self.assertEqual(
-                    s3_obj.cache_control,
-                    "max-age={:d}, public".format(expiration),
-                    msg=(
-                        f"upload_file sets proper cache-control header for "
-                        f"max-age={expiration:d}"
-                    ),
-                )
+        for expiration, response in zip(EXPIRATIONS, responses):
+            with self.subTest(expiration=expiration):
+                s3_obj = self.s3.Object(self.bucket.name, response[0])
+                if expiration == 0:
+                    self.assertEqual(
+                        s3_obj.cache_control,
+                        "max-age={:d}, private".format(expiration),
+                        msg=(
+                            f"upload_file sets proper cache-control header for "
+                            f"max-age={expiration:d}"
+                        ),
+                    )
+                else:
+                    self.assertEqual(
+                        s3_obj.cache_control,
+                        "max-age={:d}, public".format(expiration),
+                        msg=(
+                            f"upload_file sets proper cache-control header for "
+                            f"max-age={expiration:d}"
+                        ),
+                    )
 
     def test_mimetypes(self):
-        for check in TEST_MIMETYPES:
+        def upload_and_head(check):
             result = d3ploy.upload_file(
-                relative_path("./files") / check[0],
+                FILES_ROOT / check[0],
                 self.bucket.name,
-                self.s3,
+                self.s3_client,
                 "test-mimetypes",
                 PREFIX_PATH,
             )
-            self.assertTrue(s3_object_exists(self.bucket.name, result[0]))
-            s3_object = self.s3.Object(self.bucket.name, result[0])
-            self.assertEqual(
-                s3_object.content_type,
-                check[1],
-                msg="upload_file sets the correct mimetype for {} files".format(
-                    check[0].split(".")[-1],
-                ),
-            )
-
-    @patch("d3ploy.d3ploy.killswitch.is_set", return_value=True)
-    def test_upload_with_killswitch_flipped(self, *args):
-        result = d3ploy.upload_file(
-            relative_path("./files/css/sample.css"),
-            self.bucket.name,
-            self.s3,
-            "test-upload-killswitch",
-            PREFIX_PATH,
-        )
-        self.assertTupleEqual(
-            result,
-            (parent_dir / "tests/files/css/sample.css", 0),
-            msg="delete_file returns 0 when killswitch.is_set is True",
-        )
+            return d3ploy.get_object_head(self.s3_client, self.bucket.name, result[0])
+
+        # the uploads don't depend on each other, so they all go up at once and
+        # each worker fetches its own object's headers right after
+        with futures.ThreadPoolExecutor(max_workers=len(TEST_MIMETYPES)) as executor:
+            heads = executor.map(upload_and_head, TEST_MIMETYPES)
+        for check, s3_object in zip(TEST_MIMETYPES, heads):
+            with self.subTest(mimetype=check[1]):
+                self.assertIsNotNone(s3_object)
+                self.assertEqual(
+                    s3_object["ContentType"],
+                    check[1],
+                    msg="upload_file sets the correct mimetype for {} files".format(
+                        check[0].split(".")[-1],
+                    ),
+                )
 
 
-class DeleteFileTestCase(
+@shares_fixtures
+class DeleteFilesTestCase(
     BaseTestCase,
     S3BucketMixin,
-    TestFileMixin,
 ):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # the object is only put again after a test that actually deleted it;
+        # the dry run test leaves it in place
+        cls.uploaded_file = "test-delete/test.txt"
+        cls.test_file_body = (uuid.uuid4().hex + "\n").encode()
+        cls.needs_upload = True
+
     def setUp(self):
         super().setUp()
-        self.create_test_file()
-        upload_result = d3ploy.upload_file(
-            self.test_file_name,
-            self.bucket.name,
-            self.s3,
-            "test-delete-dry-run",
-            PREFIX_PATH,
-        )
-        self.assertEqual(
-            upload_result[1],
-            1,
-            msg="delete_file uploading file worked",
-        )
-        self.assertTrue(
-            s3_object_exists(self.bucket.name, upload_result[0]),
-            msg="delete_file uploading file worked",
-        )
-        self.uploaded_file = upload_result[0]
+        if self.needs_upload:
+            self.s3_client.put_object(
+                Bucket=self.bucket.name,
+                Key=self.uploaded_file,
+                Body=self.test_file_body,
+            )
+            type(self).needs_upload = False
+        # the only key in the bucket is the one this class keeps around
+        S3BucketMixin.dirty = False
 
-    def tearDown(self):
-        if s3_object_exists(self.bucket.name, self.uploaded_file):
-            self.s3.Object(self.bucket.name, self.uploaded_file).delete()
+    def expect_deletion(self):
+        type(self).needs_upload = True
 
-    def test_dry_run(self, *args):
-        result = d3ploy.delete_file(
-            self.uploaded_file,
+    @classmethod
+    def tearDownClass(cls):
+        S3BucketMixin.dirty = True
+        super().tearDownClass()
+
+    def test_dry_run(self):
+        result = d3ploy.delete_files(
+            [self.uploaded_file],
             self.bucket.name,
-            self.s3,
+            self.s3_client,
             dry_run=True,
         )
         self.assertEqual(
             result,
             1,
-            msg="delete_file dry_run=True returns 1",
+            msg="delete_files dry_run=True returns the number of keys",
         )
         self.assertTrue(
             s3_object_exists(self.bucket.name, self.uploaded_file),
-            msg="delete_file dry_run=True did not delete the file",
+            msg="delete_files dry_run=True did not delete the file",
         )
 
     def test_deletion(self):
-        result = d3ploy.delete_file(self.uploaded_file, self.bucket.name, self.s3)
-        self.assertEqual(
-            result,
-            1,
-            msg="delete_file returns 1",
-        )
-        self.assertFalse(
-            s3_object_exists(self.bucket.name, self.uploaded_file),
-            msg="delete_file did delete the file",
-        )
-
-    @patch("d3ploy.d3ploy.get_confirmation", return_value=True)
-    def test_confirmation_affirmative(self, *args):
-        result = d3ploy.delete_file(
-            self.uploaded_file,
+        self.expect_deletion()
+        result = d3ploy.delete_files(
+            [self.uploaded_file],
             self.bucket.name,
-            self.s3,
-            needs_confirmation=True,
+            self.s3_client,
         )
         self.assertEqual(
             result,
             1,
-            msg=(
-                "delete_file needs_confirmation=True returns 1 when get_confirmation "
-                "is True"
-            ),
+            msg="delete_files returns the number of keys",
         )
         self.assertFalse(
             s3_object_exists(self.bucket.name, self.uploaded_file),
-            msg=(
-                "delete_file needs_confirmation=True did delete the file when "
-                "get_confirmation is True"
-            ),
+            msg="delete_files did delete the file",
         )
 
-    @patch("d3ploy.d3ploy.get_confirmation", return_value=False)
-    def test_confirmation_negative(self, *args):
-        result = d3ploy.delete_file(
-            self.uploaded_file,
+    def test_progress_bar(self):
+        self.expect_deletion()
+        bar = Mock()
+        d3ploy.delete_files(
+            [self.uploaded_file],
             self.bucket.name,
-            self.s3,
-            needs_confirmation=True,
-        )
-        self.assertEqual(
-            result,
-            0,
-            msg=(
-                "delete_file needs_confirmation=True returns 0 when get_confirmation "
-                "is False"
-            ),
-        )
-        self.assertTrue(
-            s3_object_exists(self.bucket.name, self.uploaded_file),
-            msg=(
-                "delete_file needs_confirmation=True did not delete the file when "
-                "get_confirmation is True"
-            ),
-        )
-
-    @patch("d3ploy.d3ploy.killswitch.is_set", return_value=True)
-    def test_deletion_with_killswitch_flipped(self, *args):
-        result = d3ploy.delete_file(self.uploaded_file, self.bucket.name, self.s3)
-        self.assertEqual(
-            result,
-            0,
-            msg="delete_file returns 0 when killswitch.is_set is True",
+            self.s3_client,
+            bar=bar,
         )
+        bar.update.assert_called_once_with(1)
 
 
 class InvalidateCloudfrontTestCase(BaseTestCase):
@@ -864,59 +1113,116 @@ class InvalidateCloudfrontTestCase(BaseTestCase):
             msg="invalidate_cloudfront returns 1 invalidation ID",
         )
 
+    def test_duplicate_ids(self):
+        response = d3ploy.invalidate_cloudfront(
+            (TEST_CLOUDFRONT_DISTRIBUTION, TEST_CLOUDFRONT_DISTRIBUTION),
+            "test",
+        )
+        self.assertEqual(
+            len(response),
+            1,
+            msg="invalidate_cloudfront sends one invalidation per distribution",
+        )
+
 
+@shares_fixtures
 class SyncFilesTestCase(
     BaseTestCase,
     S3BucketMixin,
     TestFileMixin,
 ):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.deleted_file_body = (uuid.uuid4().hex + "\n").encode()
+
+    def put_deleted_file(self, bucket_path: str) -> str:
+        # stands in for a file that was synced and then removed locally; the
+        # key is put directly, so the file never has to exist on disk
+        key_name = "/".join(
+            [bucket_path, self.test_file_name.relative_to(PREFIX_PATH).as_posix()]
+        )
+        self.s3_client.put_object(
+            Bucket=self.bucket.name,
+            Key=key_name,
+            Body=self.deleted_file_body,
+        )
+        return key_name
+
     def test_bucket_path(self):
-        for prefix in ["test", "testing"]:
+        prefixes = ["test", "testing"]
+        for prefix in prefixes:
             d3ploy.sync_files(
                 "test",
-                local_path=relative_path("./files/css"),
+                local_path=CSS_ROOT,
                 bucket_name=self.bucket.name,
+                s3_client=self.s3_client,
                 bucket_path="sync_files/{}".format(prefix),
                 excludes=EXCLUDES,
             )
-            self.assertTrue(
-                s3_object_exists(
-                    self.bucket.name,
-                    "sync_files/{}/sample.css".format(prefix),
-                ),
+        # one listing checks both paths
+        uploaded = list_prefix(self.bucket.name, "sync_files/")
+        for prefix in prefixes:
+            self.assertIn(
+                "sync_files/{}/sample.css".format(prefix),
+                uploaded,
                 msg="sync_files puts files in the correct bucket path",
             )
 
-    def test_acls(self):
-        for acl in d3ploy.VALID_ACLS:
-            d3ploy.sync_files(
+    def test_builds_own_client(self):
+        with patch(
+            "d3ploy.d3ploy.boto3.session.Session", side_effect=tracked_session
+        ) as session:
+            outcome = d3ploy.sync_files(
                 "test",
-                local_path=relative_path("./files/css"),
+                local_path=CSS_ROOT,
                 bucket_name=self.bucket.name,
-                bucket_path="sync_files/test-acl-{}".format(acl),
+                bucket_path="sync_files/test-own-client",
                 excludes=EXCLUDES,
-                acl=acl,
             )
-            object_acl = self.s3.ObjectAcl(
+        session.assert_called_once_with()
+        self.assertTrue(S3BucketMixin.dirty, msg="the built client's writes are seen")
+        self.assertEqual(outcome["uploaded"], 1)
+        self.assertTrue(
+            s3_object_exists(self.bucket.name, "sync_files/test-own-client/sample.css")
+        )
+
+    def assert_acl(self, acl: str):
+        if acl in UNMOCKED_ACLS:
+            self.skipTest("{} grants aren't reported by moto".format(acl))
+        d3ploy.sync_files(
+            "test",
+            local_path=CSS_ROOT,
+            bucket_name=self.bucket.name,
+            s3_client=self.s3_client,
+            bucket_path="sync_files/test-acl-{}".format(acl),
+            excludes=EXCLUDES,
+            acl=acl,
+        )
+        self.assertListEqual(
+            s3_object_grants(
                 self.bucket.name,
                 "sync_files/test-acl-{}/sample.css".format(acl),
-            )
-            grants = []
-            for grant in object_acl.grants:
-                if grant.get("Grantee", {}).get("Type") == "CanonicalUser":
-                    continue  # skip the individual user permissions
-                grants.append(grant)
-            self.assertListEqual(
-                grants,
-                ACL_GRANTS.get(acl),
-                msg="sync_files sets the correct ACL grants for ACL {}".format(acl),
-            )
+            ),
+            ACL_GRANTS.get(acl),
+            msg="sync_files sets the correct ACL grants for ACL {}".format(acl),
+        )
+
+    def test_acl_smoke(self):
+        self.assert_acl("public-read")
+
+    @pytest.mark.slow
+    def test_acls_exhaustive(self):
+        for acl in d3ploy.VALID_ACLS:
+            with self.subTest(acl=acl):
+                self.assert_acl(acl)
 
     def test_dry_run(self):
         d3ploy.sync_files(
             "test",
-            local_path=relative_path("./files/css"),
+            local_path=CSS_ROOT,
             bucket_name=self.bucket.name,
+            s3_client=self.s3_client,
             bucket_path="sync_files/test-dry-run",
             excludes=EXCLUDES,
             dry_run=True,
@@ -927,171 +1233,211 @@ class SyncFilesTestCase(
         )
 
     def test_charset(self):
-        for charset in CHARSETS:
-            d3ploy.sync_files(
-                "test",
-                excludes=EXCLUDES,
-                local_path=relative_path("./files/html"),
-                bucket_name=self.bucket.name,
-                bucket_path="sync_files/test-charset-{}".format(charset or "none"),
-                charset=charset,
-            )
-            s3_obj = self.s3.Object(
-                self.bucket.name,
-                "sync_files/test-charset-{}/index.html".format(charset or "none"),
-            )
-            if charset:
-                self.assertEqual(
-                    s3_obj.content_type,
-                    "text/html;charset={}".format(charset),
+        # each charset syncs to its own path, so the syncs run side by side
+        # through the shared (thread-safe) client
+        with futures.ThreadPoolExecutor(max_workers=len(CHARSETS)) as executor:
+            list(
+                executor.map(
+                    lambda charset: d3ploy.sync_files(
+                        "test",
+                        excludes=EXCLUDES,
+                        local_path=HTML_ROOT,
+                        bucket_name=self.bucket.name,
+                        s3_client=self.s3_client,
+                        bucket_path="sync_files/test-charset-{}".format(
+                            charset or "none"
+                        ),
+                        charset=charset,
+                    ),
+                    CHARSETS,
                 )
-            else:
-                self.assertEqual(
-                    s3_obj.content_type,
-                    "text/html",
+            )
+        for charset in CHARSETS:
+            with self.subTest(charset=charset):
+                s3_obj = self.s3.Object(
+                    self.bucket.name,
+                    "sync_files/test-charset-{}/index.html".format(charset or "none"),
                 )
+                if charset:
+                    self.assertEqual(
+                        s3_obj.content_type,
+                        "text/html;charset={}".format(charset),
+                    )
+                else:
+                    self.assertEqual(
+                        s3_obj.content_type,
+                        "text/html",
+                    )
 
     def test_caches_explicit(self):
-        for expiration in [0, 86400, 86400 * 30, 86400 * 365]:
-            d3ploy.sync_files(
-                "test",
-                local_path=relative_path("./files/css"),
-                bucket_name=self.bucket.name,
-                bucket_path="sync_files/test-cache-{:d}".format(expiration),
-                excludes=EXCLUDES,
-                caches={"text/css": expiration},
-            )
-            s3_obj = self.s3.Object(
-                self.bucket.name,
-                "sync_files/test-cache-{:d}/sample.css".format(expiration),
-            )
-            if expiration == 0:
-                self.assertEqual(
-                    s3_obj.cache_control,
-                    "max-age={:d}, private".format(expiration),
-                    msg=(
-                        f"sync_files sets proper cache-control header for "
-                        f"max-age={expiration:d}"
+        with futures.ThreadPoolExecutor(max_workers=len(EXPIRATIONS)) as executor:
+            list(
+                executor.map(
+                    lambda expiration: d3ploy.sync_files(
+                        "test",
+                        local_path=CSS_ROOT,
+                        bucket_name=self.bucket.name,
+                        s3_client=self.s3_client,
+                        bucket_path="sync_files/test-cache-{:d}".format(expiration),
+                        excludes=EXCLUDES,
+                        caches={"text/css": expiration},
                     ),
+                    EXPIRATIONS,
                 )
-            else:
-                self.assertEqual(
-                    s3_obj.cache_control,
-                    "max-age={:d}, public".format(expiration),
-                    msg=(
-                        f"sync_files sets proper cache-control header for "
-                        f"max-age={expiration:d}"
-                    ),
+            )
+        for expiration in EXPIRATIONS:
+            with self.subTest(expiration=expiration):
+                s3_obj = self.s3.Object(
+                    self.bucket.name,
+                    "sync_files/test-cache-{:d}/sample.css".format(expiration),
                 )
+                if expiration == 0:
+                    self.assertEqual(
+                        s3_obj.cache_control,
+                        "max-age={:d}, private".format(expiration),
+                        msg=(
+                            f"sync_files sets proper cache-control header for "
+                            f"max-age={expiration:d}"
+                        ),
+                    )
+                else:
+                    self.assertEqual(
+                        s3_obj.cache_control,
+                        "max-age={:d}, public".format(expiration),
+                        msg=(
+                            f"sync_files sets proper cache-control header for "
+                            f"max-age={expiration:d}"
+                        ),
+                    )
 
     def test_caches_implicit(self):
-        for expiration in [0, 86400, 86400 * 30, 86400 * 365]:
-            d3ploy.sync_files(
-                "test",
-                local_path=relative_path("./files/css"),
-                bucket_name=self.bucket.name,
-                bucket_path="sync_files/test-cache-{:d}".format(expiration),
-                excludes=EXCLUDES,
-                caches={"text/*": expiration},
-            )
-            s3_obj = self.s3.Object(
-                self.bucket.name,
-                "sync_files/test-cache-{:d}/sample.css".format(expiration),
-            )
-            if expiration == 0:
-                self.assertEqual(
-                    s3_obj.cache_control,
-                    "max-age={:d}, private".format(expiration),
-                    msg=(
-                        f"sync_files sets proper cache-control header for "
-                        f"max-age={expiration:d}"
+        with futures.ThreadPoolExecutor(max_workers=len(EXPIRATIONS)) as executor:
+            list(
+                executor.map(
+                    lambda expiration: d3ploy.sync_files(
+                        "test",
+                        local_path=CSS_ROOT,
+                        bucket_name=self.bucket.name,
+                        s3_client=self.s3_client,
+                        bucket_path="sync_files/test-cache-{:d}".format(expiration),
+                        excludes=EXCLUDES,
+                        caches={"text/*": expiration},
                     ),
+                    EXPIRATIONS,
                 )
-            else:
-                self.assertEqual(
-                    s3_obj.cache_control,
-                    "max-age={:d}, public".format(expiration),
-                    msg=(
-                        f"sync_files sets proper cache-control header for "
-                        f"max-age={expiration:d}"
-                    ),
+            )
+        for expiration in EXPIRATIONS:
+            with self.subTest(expiration=expiration):
+                s3_obj = self.s3.Object(
+                    self.bucket.name,
+                    "sync_files/test-cache-{:d}/sample.css".format(expiration),
                 )
+                if expiration == 0:
+                    self.assertEqual(
+                        s3_obj.cache_control,
+                        "max-age={:d}, private".format(expiration),
+                        msg=(
+                            f"sync_files sets proper cache-control header for "
+                            f"max-age={expiration:d}"
+                        ),
+                    )
+                else:
+                    self.assertEqual(
+                        s3_obj.cache_control,
+                        "max-age={:d}, public".format(expiration),
+                        msg=(
+                            f"sync_files sets proper cache-control header for "
+                            f"max-age={expiration:d}"
+                        ),
+                    )
 
     def test_multiple_processes(self):
         d3ploy.sync_files(
             "test",
-            local_path=relative_path("./files"),
+            local_path=FILES_ROOT,
             bucket_name=self.bucket.name,
+            s3_client=self.s3_client,
             bucket_path="sync_files/test-multiple-processes",
             excludes=EXCLUDES,
             processes=10,
             gitignore=True,
         )
-        passed = 0
-        for fn in TEST_FILES:
-            if s3_object_exists(
-                self.bucket.name,
-                "sync_files/test-multiple-processes/{}".format(
-                    str(fn).replace("tests/files/", "")
-                ),
-            ):
-                passed += 1
-            else:
-                print("missing file", fn)
+        # one listing covers every file instead of a HEAD request per file
+        uploaded = list_prefix(self.bucket.name, "sync_files/test-multiple-processes/")
+        missing = [
+            key_name
+            for key_name in TEST_KEYS
+            if "sync_files/test-multiple-processes/" + key_name not in uploaded
+        ]
+        self.assertListEqual(missing, [])
+
+    def test_large_files(self):
+        with open(self.test_file_name, "wb") as f:
+            f.truncate(d3ploy.MULTIPART_THRESHOLD + 1)
+        outcome = d3ploy.sync_files(
+            "test",
+            local_path=TXT_ROOT,
+            bucket_name=self.bucket.name,
+            s3_client=self.s3_client,
+            bucket_path="sync_files/test-large-files",
+            excludes=EXCLUDES,
+        )
         self.assertEqual(
-            passed,
-            len(TEST_FILES),
+            outcome["uploaded"],
+            1,
         )
-
-    def test_deleting_files(self):
-        self.create_test_file()
-        self.assertTrue(self.test_file_name.exists())
-        uploaded_file = d3ploy.upload_file(
-            self.test_file_name,
+        s3_obj = self.s3.Object(
             self.bucket.name,
-            self.s3,
-            "sync_files/test-deleting",
-            PREFIX_PATH,
+            "sync_files/test-large-files/{}".format(self.test_file_name.name),
         )
-        self.destroy_test_file()
-        self.assertFalse(self.test_file_name.exists())
-        self.assertTrue(s3_object_exists(self.bucket.name, uploaded_file[0]))
+        self.assertIn(
+            "-",
+            s3_obj.e_tag,
+            msg="sync_files uses multipart uploads for large files",
+        )
+        # run it again and make sure the stored hash stops a second upload
+        outcome = d3ploy.sync_files(
+            "test",
+            local_path=TXT_ROOT,
+            bucket_name=self.bucket.name,
+            s3_client=self.s3_client,
+            bucket_path="sync_files/test-large-files",
+            excludes=EXCLUDES,
+        )
+        self.assertEqual(
+            outcome["uploaded"],
+            0,
+        )
+
+    def test_deleting_files(self):
+        uploaded_file = self.put_deleted_file("sync_files/test-deleting")
         d3ploy.sync_files(
             "test",
-            local_path=relative_path("./files"),
+            local_path=FILES_ROOT,
             bucket_name=self.bucket.name,
+            s3_client=self.s3_client,
             bucket_path="sync_files/test-deleting",
             excludes=EXCLUDES,
             processes=10,
             gitignore=True,
             delete=True,
         )
-        self.assertFalse(s3_object_exists(self.bucket.name, uploaded_file[0]))
+        self.assertFalse(s3_object_exists(self.bucket.name, uploaded_file))
 
     def test_deleting_files_single_process(self):
-        self.create_test_file()
-        self.assertTrue(self.test_file_name.exists())
-        uploaded_file = d3ploy.upload_file(
-            self.test_file_name,
-            self.bucket.name,
-            self.s3,
-            "sync_files/test-deleting-single-process",
-            PREFIX_PATH,
-        )
-        self.destroy_test_file()
-        self.assertFalse(self.test_file_name.exists())
-        self.assertTrue(s3_object_exists(self.bucket.name, uploaded_file[0]))
+        uploaded_file = self.put_deleted_file("sync_files/test-deleting-single-process")
         outcome = d3ploy.sync_files(
             "test",
-            local_path=relative_path("./files"),
+            local_path=FILES_ROOT,
             bucket_name=self.bucket.name,
+            s3_client=self.s3_client,
             bucket_path="sync_files/test-deleting-single-process",
             excludes=EXCLUDES,
             processes=1,
             gitignore=True,
             delete=True,
         )
-        self.assertFalse(s3_object_exists(self.bucket.name, uploaded_file[0]))
+        self.assertFalse(s3_object_exists(self.bucket.name, uploaded_file))
         self.assertGreaterEqual(
             outcome["deleted"],
             1,
@@ -1099,21 +1445,12 @@ class SyncFilesTestCase(
 
     @patch("d3ploy.d3ploy.get_confirmation", return_value=True)
     def test_deleting_files_with_confirmation(self, *args):
-        self.create_test_file()
-        self.assertTrue(self.test_file_name.exists())
-        uploaded_file = d3ploy.upload_file(
-            self.test_file_name,
-            self.bucket.name,
-            self.s3,
-            "sync_files/test-deleting",
-            PREFIX_PATH,
-        )
-        self.destroy_test_file()
-        self.assertTrue(s3_object_exists(self.bucket.name, uploaded_file[0]))
+        uploaded_file = self.put_deleted_file("sync_files/test-deleting")
         d3ploy.sync_files(
             "test",
-            local_path=relative_path("./files"),
+            local_path=FILES_ROOT,
             bucket_name=self.bucket.name,
+            s3_client=self.s3_client,
             bucket_path="sync_files/test-deleting",
             excludes=EXCLUDES,
             processes=10,
@@ -1121,25 +1458,16 @@ class SyncFilesTestCase(
             delete=True,
             confirm=True,
         )
-        self.assertFalse(s3_object_exists(self.bucket.name, uploaded_file[0]))
+        self.assertFalse(s3_object_exists(self.bucket.name, uploaded_file))
 
     @patch("d3ploy.d3ploy.get_confirmation", return_value=False)
     def test_deleting_files_with_confirmation_denied(self, *args):
-        self.create_test_file()
-        self.assertTrue(self.test_file_name.exists())
-        uploaded_file = d3ploy.upload_file(
-            self.test_file_name,
-            self.bucket.name,
-            self.s3,
-            "sync_files/test-deleting",
-            PREFIX_PATH,
-        )
-        self.assertTrue(s3_object_exists(self.bucket.name, uploaded_file[0]))
-        self.destroy_test_file()
+        uploaded_file = self.put_deleted_file("sync_files/test-deleting")
         d3ploy.sync_files(
             "test",
-            local_path=relative_path("./files"),
+            local_path=FILES_ROOT,
             bucket_name=self.bucket.name,
+            s3_client=self.s3_client,
             bucket_path="sync_files/test-deleting",
             excludes=EXCLUDES,
             processes=10,
@@ -1147,7 +1475,21 @@ class SyncFilesTestCase(
             delete=True,
             confirm=True,
         )
-        self.assertTrue(s3_object_exists(self.bucket.name, uploaded_file[0]))
+        self.assertTrue(s3_object_exists(self.bucket.name, uploaded_file))
+
+    def test_deleting_files_keeps_sibling_paths(self):
+        sibling_key = "sync_files/test-deleting-sibling/sample.css"
+        self.s3_client.put_object(Bucket=self.bucket.name, Key=sibling_key, Body=b"")
+        d3ploy.sync_files(
+            "test",
+            local_path=CSS_ROOT,
+            bucket_name=self.bucket.name,
+            s3_client=self.s3_client,
+            bucket_path="sync_files/test-deleting",
+            excludes=EXCLUDES,
+            delete=True,
+        )
+        self.assertTrue(s3_object_exists(self.bucket.name, sibling_key))
 
     def test_no_bucket_name(self):
         with self.assertRaises(SystemExit) as exception:
@@ -1157,39 +1499,84 @@ class SyncFilesTestCase(
             os.EX_NOINPUT,
         )
 
-    def test_cloudfront_id(self):
-        for distro_ids in [[TEST_CLOUDFRONT_DISTRIBUTION], []]:
-            outcome = d3ploy.sync_files(
+    def test_bucket_access_denied(self):
+        denied = botocore.exceptions.ClientError(
+            {"Error": {"Code": "403", "Message": "Forbidden"}}, "HeadBucket"
+        )
+        std_err = io.StringIO()
+        with (
+            patch.object(self.s3_client, "head_bucket", side_effect=denied),
+            contextlib.redirect_stderr(std_err),
+            self.assertRaises(SystemExit) as exception,
+        ):
+            d3ploy.sync_files(
                 "test",
-                local_path=relative_path("./files/html"),
+                local_path=CSS_ROOT,
                 bucket_name=self.bucket.name,
-                bucket_path="sync_files/test-cloudfront-id",
-                excludes=EXCLUDES,
-                cloudfront_id=distro_ids,
-            )
-            self.assertEqual(
-                outcome["invalidated"],
-                len(distro_ids),
+                s3_client=self.s3_client,
             )
-            # run it again and make sure we don't send another invalidation
-            outcome = d3ploy.sync_files(
+        self.assertEqual(exception.exception.code, os.EX_NOUSER)
+        self.assertIn(
+            boto3.Session().get_credentials().access_key,
+            std_err.getvalue(),
+        )
+
+    def test_bucket_check_error(self):
+        # anything other than access denied is left for the caller to see
+        error = botocore.exceptions.ClientError(
+            {"Error": {"Code": "500", "Message": "Internal Error"}}, "HeadBucket"
+        )
+        with (
+            patch.object(self.s3_client, "head_bucket", side_effect=error),
+            self.assertRaises(botocore.exceptions.ClientError),
+        ):
+            d3ploy.sync_files(
                 "test",
-                local_path=relative_path("./files/html"),
+                local_path=CSS_ROOT,
                 bucket_name=self.bucket.name,
-                bucket_path="sync_files/test-cloudfront-id",
-                excludes=EXCLUDES,
-                cloudfront_id=distro_ids,
-            )
-            self.assertEqual(
-                outcome["invalidated"],
-                0,
+                s3_client=self.s3_client,
             )
 
+    def test_cloudfront_id(self):
+        for distro_ids in [[TEST_CLOUDFRONT_DISTRIBUTION], []]:
+            with self.subTest(distro_ids=distro_ids):
+                outcome = d3ploy.sync_files(
+                    "test",
+                    local_path=HTML_ROOT,
+                    bucket_name=self.bucket.name,
+                    s3_client=self.s3_client,
+                    bucket_path="sync_files/test-cloudfront-id",
+                    excludes=EXCLUDES,
+                    cloudfront_id=distro_ids,
+                )
+                self.assertEqual(
+                    outcome["invalidated"],
+                    len(distro_ids),
+                )
+                # run it again and make sure we don't send another invalidation
+                outcome = d3ploy.sync_files(
+                    "test",
+                    local_path=HTML_ROOT,
+                    bucket_name=self.bucket.name,
+                    s3_client=self.s3_client,
+                    bucket_path="sync_files/test-cloudfront-id",
+                    excludes=EXCLUDES,
+                    cloudfront_id=distro_ids,
+                )
+                self.assertEqual(
+                    outcome["invalidated"],
+                    0,
+                )
+
 
+# only reads the fixtures, so these run in parallel on any pytest-xdist worker
 class CLITestCase(BaseTestCase):
     @classmethod
     def setUpClass(cls):
+        # cli looks for its config in the working directory; no test moves out
+        # of it for good, so the class only changes into it once
         cls.cwd = os.getcwd()
+        os.chdir(FILES_ROOT)
 
     @classmethod
     def tearDownClass(cls):
@@ -1197,14 +1584,20 @@ class CLITestCase(BaseTestCase):
 
     def setUp(self):
         super().setUp()
-        os.chdir(relative_path("./files").resolve())
-        self.patcher = patch("d3ploy.d3ploy.sync_files", new=MockSyncFiles())
+        # autospec makes cli() call sync_files with arguments it actually accepts
+        self.patcher = patch("d3ploy.d3ploy.sync_files", autospec=True)
         self.sync_files = self.patcher.start()
 
     def tearDown(self):
         super().tearDown()
         self.patcher.stop()
 
+    def synced(self, name: str):
+        return self.sync_files.call_args.kwargs[name]
+
+    def test_parser_is_cached(self):
+        self.assertIs(d3ploy.get_parser(), d3ploy.get_parser())
+
     def test_version(self):
         for testargs in [["-v"], ["--version"]]:
             with patch.object(sys, "argv", ["d3ploy"] + testargs):
@@ -1231,15 +1624,16 @@ class CLITestCase(BaseTestCase):
         with patch.object(sys, "argv", ["d3ploy", "test"]):
             d3ploy.cli()
             self.assertEqual(
-                self.sync_files.env,
+                self.sync_files.call_args.args[0],
                 "test",
             )
 
         with patch.object(sys, "argv", ["d3ploy", "test", "prod"]):
+            self.sync_files.reset_mock()
             d3ploy.cli()
-            self.assertEqual(
-                self.sync_files.env,
-                "prod",
+            self.assertCountEqual(
+                [x.args[0] for x in self.sync_files.call_args_list],
+                ["test", "prod"],
             )
 
         with patch.object(sys, "argv", ["d3ploy"]):
@@ -1257,7 +1651,7 @@ class CLITestCase(BaseTestCase):
         ):
             d3ploy.cli()
             self.assertEqual(
-                self.sync_files.bucket_name,
+                self.synced("bucket_name"),
                 TEST_BUCKET + "-foo",
             )
 
@@ -1265,7 +1659,7 @@ class CLITestCase(BaseTestCase):
         with patch.object(sys, "argv", ["d3ploy", "test"]):
             d3ploy.cli()
             self.assertEqual(
-                self.sync_files.bucket_name,
+                self.synced("bucket_name"),
                 "d3ploy-tests",
             )
 
@@ -1274,7 +1668,7 @@ class CLITestCase(BaseTestCase):
         with patch.object(sys, "argv", ["d3ploy", "test", "--local-path", "./tests/"]):
             d3ploy.cli()
             self.assertEqual(
-                self.sync_files.local_path,
+                self.synced("local_path"),
                 "./tests/",
             )
 
@@ -1282,7 +1676,7 @@ class CLITestCase(BaseTestCase):
         with patch.object(sys, "argv", ["d3ploy", "test"]):
             d3ploy.cli()
             self.assertEqual(
-                self.sync_files.local_path,
+                self.synced("local_path"),
                 ".",
             )
 
@@ -1291,7 +1685,7 @@ class CLITestCase(BaseTestCase):
         with patch.object(sys, "argv", ["d3ploy", "test", "--bucket-path", "/tests/"]):
             d3ploy.cli()
             self.assertEqual(
-                self.sync_files.bucket_path,
+                self.synced("bucket_path"),
                 "/tests/",
             )
 
@@ -1299,7 +1693,7 @@ class CLITestCase(BaseTestCase):
         with patch.object(sys, "argv", ["d3ploy", "test"]):
             d3ploy.cli()
             self.assertEqual(
-                self.sync_files.bucket_path,
+                self.synced("bucket_path"),
                 "/test/",
             )
 
@@ -1307,15 +1701,12 @@ class CLITestCase(BaseTestCase):
         # test passing the variable to the cli
         with patch.object(sys, "argv", ["d3ploy", "test", "--exclude", ".gitkeep"]):
             d3ploy.cli()
-            self.sync_files.excludes.sort()
-            expected = [
-                ".gitkeep",
-                ".d3ploy.json",
-            ]
-            expected.sort()
-            self.assertListEqual(
-                self.sync_files.excludes,
-                expected,
+            self.assertCountEqual(
+                self.synced("excludes"),
+                [
+                    ".gitkeep",
+                    ".d3ploy.json",
+                ],
             )
 
         # test passing multiple variables to the cli
@@ -1323,126 +1714,97 @@ class CLITestCase(BaseTestCase):
             sys, "argv", ["d3ploy", "test", "--exclude", ".gitkeep", "--exclude", "foo"]
         ):
             d3ploy.cli()
-            self.sync_files.excludes.sort()
-            expected = [
-                ".gitkeep",
-                "foo",
-                ".d3ploy.json",
-            ]
-            expected.sort()
-            self.assertListEqual(
-                self.sync_files.excludes,
-                expected,
+            self.assertCountEqual(
+                self.synced("excludes"),
+                [
+                    ".gitkeep",
+                    "foo",
+                    ".d3ploy.json",
+                ],
             )
 
         # test getting the variable from the config file
         with patch.object(sys, "argv", ["d3ploy", "prod"]):
             d3ploy.cli()
-            self.sync_files.excludes.sort()
-            expected = [
-                ".gitignore",
-                ".gitkeep",
-                ".d3ploy.json",
-            ]
-            expected.sort()
-            self.assertEqual(
-                self.sync_files.excludes,
-                expected,
+            self.assertCountEqual(
+                self.synced("excludes"),
+                [
+                    ".gitignore",
+                    ".gitkeep",
+                    ".d3ploy.json",
+                ],
             )
 
     def test_acl(self):
         # test passing the variable to the cli
         for acl in d3ploy.VALID_ACLS:
-            with patch.object(sys, "argv", ["d3ploy", "test", "--acl", acl]):
-                d3ploy.cli()
-                self.assertEqual(
-                    self.sync_files.acl,
-                    acl,
-                )
+            with self.subTest(acl=acl):
+                with patch.object(sys, "argv", ["d3ploy", "test", "--acl", acl]):
+                    d3ploy.cli()
+                    self.assertEqual(
+                        self.synced("acl"),
+                        acl,
+                    )
 
         # test passing no variable to the cli
         with patch.object(sys, "argv", ["d3ploy", "test"]):
             d3ploy.cli()
             self.assertEqual(
-                self.sync_files.acl,
+                self.synced("acl"),
                 None,
             )
 
-    def test_force(self):
-        for testargs in [["-f"], ["--force"], []]:
-            with patch.object(sys, "argv", ["d3ploy", "test"] + testargs):
-                d3ploy.cli()
-                if testargs:
-                    self.assertTrue(self.sync_files.force)
-                else:
-                    self.assertFalse(self.sync_files.force)
+    def run_cli(self, *testargs: str):
+        with patch.object(sys, "argv", ["d3ploy", "test", *testargs]):
+            d3ploy.cli()
 
-    def test_dry_run(self):
-        for testargs in [["-n"], ["--dry-run"], []]:
-            with patch.object(sys, "argv", ["d3ploy", "test"] + testargs):
-                d3ploy.cli()
-                if testargs:
-                    self.assertTrue(self.sync_files.dry_run)
-                else:
-                    self.assertFalse(self.sync_files.dry_run)
+    def test_flags(self):
+        # every boolean flag is off unless one of its spellings is passed
+        for attr, spellings in [
+            ("force", ["-f", "--force"]),
+            ("dry_run", ["-n", "--dry-run"]),
+            ("gitignore", ["--gitignore"]),
+            ("delete", ["--delete"]),
+            ("confirm", ["--confirm"]),
+        ]:
+            for flag in spellings:
+                with self.subTest(flag=flag):
+                    self.run_cli(flag)
+                    self.assertTrue(self.synced(attr))
+            with self.subTest(attr=attr):
+                self.run_cli()
+                self.assertFalse(self.synced(attr))
 
     def test_charset(self):
         for charset in CHARSETS:
-            with patch.object(sys, "argv", ["d3ploy", "test", "--charset", charset]):
-                d3ploy.cli()
-                if charset:
-                    self.assertEqual(
-                        self.sync_files.charset,
-                        charset,
-                    )
-                else:
-                    self.assertFalse(self.sync_files.charset)
-
-    def test_gitignore(self):
-        for testargs in [["--gitignore"], []]:
-            with patch.object(sys, "argv", ["d3ploy", "test"] + testargs):
-                d3ploy.cli()
-                if testargs:
-                    self.assertTrue(self.sync_files.gitignore)
-                else:
-                    self.assertFalse(self.sync_files.gitignore)
+            with self.subTest(charset=charset):
+                with patch.object(
+                    sys, "argv", ["d3ploy", "test", "--charset", charset]
+                ):
+                    d3ploy.cli()
+                    if charset:
+                        self.assertEqual(
+                            self.synced("charset"),
+                            charset,
+                        )
+                    else:
+                        self.assertFalse(self.synced("charset"))
 
     def test_processes(self):
         for testargs in [["-p"], ["--processes"]]:
             for count in [1, 5, 10]:
-                with patch.object(
-                    sys, "argv", ["d3ploy", "test"] + testargs + [str(count)]
-                ):
-                    d3ploy.cli()
+                with self.subTest(testargs=testargs, count=count):
+                    self.run_cli(*testargs, str(count))
                     self.assertEqual(
-                        self.sync_files.processes,
+                        self.synced("processes"),
                         count,
                     )
 
-        with patch.object(sys, "argv", ["d3ploy", "test"]):
-            d3ploy.cli()
-            self.assertEqual(
-                self.sync_files.processes,
-                10,
-            )
-
-    def test_delete(self):
-        for testargs in [["--delete"], []]:
-            with patch.object(sys, "argv", ["d3ploy", "test"] + testargs):
-                d3ploy.cli()
-                if testargs:
-                    self.assertTrue(self.sync_files.delete)
-                else:
-                    self.assertFalse(self.sync_files.delete)
-
-    def test_confirm(self):
-        for testargs in [["--confirm"], []]:
-            with patch.object(sys, "argv", ["d3ploy", "test"] + testargs):
-                d3ploy.cli()
-                if testargs:
-                    self.assertTrue(self.sync_files.confirm)
-                else:
-                    self.assertFalse(self.sync_files.confirm)
+        self.run_cli()
+        self.assertEqual(
+            self.synced("processes"),
+            10,
+        )
 
     def test_cloudfront_id(self):
         for distro_ids in [
@@ -1450,33 +1812,65 @@ class CLITestCase(BaseTestCase):
             [],
             [TEST_CLOUDFRONT_DISTRIBUTION, TEST_CLOUDFRONT_DISTRIBUTION + "1"],
         ]:
-            distro_ids.sort()
-            testargs = []
-            for distro_id in distro_ids:
-                testargs.append("--cloudfront-id")
-                testargs.append(distro_id)
-            with patch.object(sys, "argv", ["d3ploy", "test"] + testargs):
-                d3ploy.cli()
-                self.sync_files.cloudfront_id.sort()
-                self.assertListEqual(
-                    self.sync_files.cloudfront_id,
-                    distro_ids,
-                )
+            with self.subTest(distro_ids=distro_ids):
+                testargs = []
+                for distro_id in distro_ids:
+                    testargs.append("--cloudfront-id")
+                    testargs.append(distro_id)
+                with patch.object(sys, "argv", ["d3ploy", "test"] + testargs):
+                    d3ploy.cli()
+                    self.assertCountEqual(
+                        self.synced("cloudfront_id"),
+                        distro_ids,
+                    )
 
     def test_all(self):
         with patch.object(sys, "argv", ["d3ploy", "--all"]):
             d3ploy.cli()
             self.assertIn(
-                self.sync_files.env,
+                self.sync_files.call_args.args[0],
                 ["test", "prod"],
             )
 
+    def test_all_with_confirm_runs_one_at_a_time(self):
+        # prompts read from stdin, so confirmed deploys stay on the main thread
+        threads = []
+        self.sync_files.side_effect = lambda *args, **kwargs: threads.append(
+            threading.current_thread()
+        )
+        self.run_cli("--all", "--confirm")
+        self.assertCountEqual(
+            [x.args[0] for x in self.sync_files.call_args_list],
+            ["test", "prod"],
+        )
+        self.assertEqual(threads, [threading.main_thread()] * 2)
+
+    def test_all_stops_on_error(self):
+        stopped = []
+
+        def sync_files(env, **kwargs):
+            if env == "test":
+                d3ploy.alert("test failed", os.EX_NOINPUT)
+            # the other environment keeps going until the failure stops it
+            stopped.append(d3ploy.killswitch.wait(timeout=5))
+
+        self.sync_files.side_effect = sync_files
+        with (
+            patch.object(sys, "argv", ["d3ploy", "--all"]),
+            contextlib.redirect_stderr(io.StringIO()),
+            self.assertRaises(SystemExit) as exception,
+        ):
+            d3ploy.cli()
+        self.assertEqual(exception.exception.code, os.EX_NOINPUT)
+        self.assertEqual(stopped, [True])
+        self.assertFalse(d3ploy.killswitch.is_set())
+
     def test_config(self):
         # test that a non default config file location works
         with patch.object(sys, "argv", ["d3ploy", "prod", "-c", ".test-d3ploy"]):
             d3ploy.cli()
             self.assertEqual(
-                self.sync_files.bucket_path,
+                self.synced("bucket_path"),
                 "/alt-config/",
             )
 
@@ -1499,28 +1893,25 @@ class CLITestCase(BaseTestCase):
             )
 
     def test_quiet(self):
-        with patch.object(sys, "argv", ["d3ploy", "test"]):
-            d3ploy.QUIET = False
-            d3ploy.cli()
-            self.assertFalse(d3ploy.QUIET)
-
-        with patch.object(sys, "argv", ["d3ploy", "test", "-q"]):
-            d3ploy.QUIET = False
-            d3ploy.cli()
-            self.assertTrue(d3ploy.QUIET)
-
-        with patch.object(sys, "argv", ["d3ploy", "test", "--quiet"]):
-            d3ploy.QUIET = False
-            d3ploy.cli()
-            self.assertTrue(d3ploy.QUIET)
-
-        d3ploy.QUIET = False
+        # cli() sets the module global, so each case runs inside a patch that
+        # puts the previous value back even when an assertion fails
+        for testargs, quiet in [([], False), (["-q"], True), (["--quiet"], True)]:
+            with self.subTest(testargs=testargs), patch.object(d3ploy, "QUIET", False):
+                self.run_cli(*testargs)
+                self.assertIs(d3ploy.QUIET, quiet)
 
     def test_old_config_check(self):
-        config_file = relative_path("./files/deploy.json")
-        config_file.write_text("")
+        # pretend the old config file is there rather than writing one, so the
+        # other tests never see it in tests/files
+        exists = pathlib.Path.exists
         std_err = io.StringIO()
         with (
+            patch.object(
+                pathlib.Path,
+                "exists",
+                autospec=True,
+                side_effect=lambda path: path.name == "deploy.json" or exists(path),
+            ),
             self.assertRaises(SystemExit) as exception,
             contextlib.redirect_stderr(std_err),
         ):
@@ -1533,7 +1924,6 @@ class CLITestCase(BaseTestCase):
             "It looks like you have an old version of deploy.json in your project",
             std_err.getvalue(),
         )
-        config_file.unlink()
 
     def test_positive_int(self):
         with self.assertRaises(argparse.ArgumentTypeError):
@@ -1552,27 +1942,209 @@ class CLITestCase(BaseTestCase):
             d3ploy.processes_int(50),
             50,
         )
+        self.assertEqual(
+            d3ploy.processes_int("20"),
+            20,
+        )
         with self.assertRaises(argparse.ArgumentTypeError):
             d3ploy.processes_int(51)
 
 
 class get_progress_barTests(BaseTestCase):
+    @patch("d3ploy.d3ploy.QUIET", True)
     def test_quiet(self):
-        d3ploy.QUIET = True
         bar = d3ploy.get_progress_bar()
         self.assertTrue(bar.disable)
-        d3ploy.QUIET = False
 
+    @patch("d3ploy.d3ploy.tqdm")
+    def test_position(self, tqdm):
+        def make_bar(position):
+            d3ploy.bar_position.value = position
+            d3ploy.get_progress_bar()
+            return tqdm.call_args.kwargs["position"]
+
+        # bars take the line set for the thread that made them, and tqdm picks
+        # one for any other thread
+        with futures.ThreadPoolExecutor(max_workers=1) as executor:
+            self.assertEqual(executor.submit(make_bar, 2).result(), 2)
+        d3ploy.get_progress_bar()
+        self.assertIsNone(tqdm.call_args.kwargs["position"])
+
+
+class get_transfer_configTests(BaseTestCase):
+    def test_config_is_cached(self):
+        self.assertIs(d3ploy.get_transfer_config(), d3ploy.get_transfer_config())
+        self.assertEqual(d3ploy.get_transfer_config(4).max_request_concurrency, 4)
+
+
+@shares_fixtures
+class get_remote_indexTests(BaseTestCase, S3BucketMixin):
+    def test_split_listing(self):
+        for key_name in [
+            "remote-index/top.txt",
+            "remote-index/a/one.txt",
+            "remote-index/a/b/two.txt",
+            "remote-index/c/three.txt",
+            "remote-indexes/other.txt",
+        ]:
+            self.s3_client.put_object(Bucket=self.bucket.name, Key=key_name, Body=b"")
+        for bucket_path in ["remote-index", "/remote-index/", ""]:
+            with self.subTest(bucket_path=bucket_path):
+                self.assertSetEqual(
+                    set(
+                        d3ploy.get_remote_index(
+                            self.s3_client, self.bucket.name, bucket_path, 4
+                        )
+                    ),
+                    set(
+                        d3ploy.get_remote_index(
+                            self.s3_client, self.bucket.name, bucket_path
+                        )
+                    ),
+                )
 
-class display_outputTests(BaseTestCase):
-    def test_quiet(self):
-        d3ploy.QUIET = True
-        std_out = io.StringIO()
-        with contextlib.redirect_stdout(std_out):
-            d3ploy.alert("Test message")
-            d3ploy.display_output()
-        self.assertEqual(std_out.getvalue(), "")
-        d3ploy.QUIET = False
+    def test_split_listing_with_empty_path_segments(self):
+        # keys written by other tools can hold "//" or start with "/", which
+        # must not send the split listing back to the prefix it started from
+        for bucket_path, key_name in [
+            ("site", "site//a/x.html"),
+            ("", "/a/x.html"),
+        ]:
+            with self.subTest(key_name=key_name):
+                self.s3_client.put_object(
+                    Bucket=self.bucket.name, Key=key_name, Body=b""
+                )
+                self.assertIn(
+                    key_name,
+                    d3ploy.get_remote_index(
+                        self.s3_client, self.bucket.name, bucket_path, 4
+                    ),
+                )
+                self.s3_client.delete_object(Bucket=self.bucket.name, Key=key_name)
+
+
+class run_jobsTests(BaseTestCase):
+    def test_results(self):
+        results = d3ploy.run_jobs(2, pow, range(100), 2)
+        self.assertCountEqual(
+            results,
+            [x**2 for x in range(100)],
+        )
+
+    def test_errors(self):
+        with self.assertRaises(ZeroDivisionError):
+            d3ploy.run_jobs(2, divmod, [1, 2, 3], 0)
+
+    def test_killswitch_flipped(self):
+        # the killswitch is a plain Event, so flip it rather than patching
+        d3ploy.killswitch.set()
+        try:
+            results = d3ploy.run_jobs(2, pow, range(100), 2)
+        finally:
+            d3ploy.killswitch.clear()
+        self.assertEqual(
+            results,
+            [],
+            msg="run_jobs doesn't start jobs when killswitch.is_set is True",
+        )
+
+    def test_killswitch_flipped_while_running(self):
+        def flip_killswitch(x):
+            # give run_jobs time to queue up work before flipping the switch
+            time.sleep(0.1)
+            d3ploy.killswitch.set()
+            return x
+
+        try:
+            results = d3ploy.run_jobs(1, flip_killswitch, range(100))
+        finally:
+            d3ploy.killswitch.clear()
+        self.assertLess(
+            len(results),
+            8,
+            msg="run_jobs drops queued jobs once killswitch is set",
+        )
+
+
+class compile_ignore_patternsTests(BaseTestCase):
+    def test_matches_pathspec(self):
+        patterns = [
+            pathspec.patterns.GitWildMatchPattern(x)
+            for x in ["*.ignore", "!keep.ignore", "build/", "# comment", ""]
+        ]
+        spec = pathspec.PathSpec(patterns)
+        is_ignored = d3ploy.compile_ignore_patterns(patterns)
+        for path in [
+            "test.ignore",
+            "js/test.ignore",
+            "keep.ignore",
+            "js/keep.ignore",
+            "build/index.html",
+            "src/build/index.html",
+            "build.html",
+            "/tmp/files/test.ignore",
+        ]:
+            self.assertEqual(
+                is_ignored(path),
+                spec.match_file(path),
+                msg=f"compile_ignore_patterns matches pathspec for {path}",
+            )
+
+    def test_unfusable_patterns(self):
+        # a backreference can't survive its group being made non-capturing, so
+        # these fall back to pathspec's own matching
+        patterns = [
+            pathspec.patterns.GitWildMatchPattern("*.ignore"),
+            pathspec.RegexPattern(r"^(?P<name>\w+)-(?P=name)$"),
+        ]
+        is_ignored = d3ploy.compile_ignore_patterns(patterns)
+        for path, ignored in [
+            ("test.ignore", True),
+            ("same-same", True),
+            ("same-different", False),
+        ]:
+            with self.subTest(path=path):
+                self.assertIs(bool(is_ignored(path)), ignored)
+
+    def test_no_patterns(self):
+        is_ignored = d3ploy.compile_ignore_patterns([])
+        self.assertFalse(is_ignored("test.ignore"))
+
+
+class get_content_headersTests(BaseTestCase):
+    def test_headers(self):
+        content_headers = d3ploy.get_content_headers(
+            {"text/css": 0, "image/*": 300},
+            "UTF-8",
+        )
+        self.assertEqual(
+            content_headers[".css"],
+            {
+                "ContentType": "text/css;charset=UTF-8",
+                "CacheControl": "max-age=0, private",
+            },
+        )
+        self.assertEqual(
+            content_headers[".png"],
+            {
+                "ContentType": "image/png",
+                "CacheControl": "max-age=300, public",
+            },
+        )
+        self.assertEqual(
+            content_headers[".json"],
+            {"ContentType": "application/json"},
+        )
+
+    def test_headers_are_cached(self):
+        self.assertIs(
+            d3ploy.get_content_headers({"text/css": 0, "image/*": 300}, "UTF-8"),
+            d3ploy.get_content_headers({"image/*": 300, "text/css": 0}, "UTF-8"),
+        )
+        self.assertIsNot(
+            d3ploy.get_content_headers({"text/css": 0}, "UTF-8"),
+            d3ploy.get_content_headers({"text/css": 0}),
+        )
 
 
 if __name__ == "__main__":
@@ -1588,10 +2160,10 @@ if __name__ == "__main__":
     config["defaults"]["bucket_name"] = TEST_BUCKET
     config_file.write_text(json.dumps(config, indent=2))
 
-    unittest.main(
-        buffer=True,
-        verbosity=2,
-    )
+    # pytest-xdist (configured in pyproject.toml) spreads the tests over every core
+    exit_code = pytest.main([__file__])
 
     if not svn_dir_existed:
         shutil.rmtree(svn_dir)
+
+    sys.exit(exit_code)